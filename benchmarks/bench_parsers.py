@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+"""
+bench_parsers.py
+
+Times each stage of the datparser and energyfarm_datparser parsers on a
+synthetic TOA5 file, and reports records per second and peak memory.
+Results are written as JSON, and compared with an earlier run given as the
+baseline so a slower stage shows up as a number.
+"""
+
+import argparse
+import csv
+import gc
+import imp
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import dateutil.tz
+import numpy as np
+
+from toa5gen import *
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Slowdown against the baseline reported as a regression.
+DEFAULT_TOLERANCE = 0.2
+
+TZ = dateutil.tz.tzoffset("-07:00", -7 * 60 * 60)
+
+# Both parsers are called parser.py, load each under its own name.
+def load_parser(directory):
+	module = imp.load_source('%s_parser' % directory, os.path.join(ROOT, directory, 'parser.py'))
+	module.debug_log = lambda message: None
+	return module
+
+def read_rows(path):
+	with open(path) as csvfile:
+		lines = csvfile.readlines()
+	names = json.loads('[%s]' % lines[1])
+	return [dict(zip(names, row)) for row in csv.reader(lines[4:])]
+
+# ----------------------------------------------------------------------
+# Stages of each profile, as (name, setup, run).
+# setup(path) returns the arguments of run, and isn't timed.
+
+def terra_stages(path, cutoff):
+	dat = load_parser('datparser')
+
+	def parsed(path):
+		return (dat.parse_file(path, TZ),)
+
+	def chunks(path):
+		records = dat.parse_file(path, TZ)
+		starts = [dat.recordTimeStamp(record, 'start') // cutoff for record in records]
+		groups = []
+		for index, record in enumerate(records):
+			if index == 0 or starts[index] != starts[index - 1]:
+				groups.append([])
+			groups[-1].append(record['properties'])
+		return (groups,)
+
+	def transform(path):
+		with open(path) as csvfile:
+			props = dat.parse_file_header(csvfile)['props']
+		return (props, read_rows(path))
+
+	return [
+		('parse_file', lambda path: (path,), lambda path: dat.parse_file(path, TZ)),
+		('transformProps', transform, lambda props, rows: [dat.transformProps(props, row) for row in rows]),
+		('aggregate', parsed, lambda records: dat.aggregate(cutoff, TZ, records, None)),
+		('aggregateProps', chunks, lambda groups: [dat.aggregateProps(group) for group in groups]),
+		('parse_file_columns', lambda path: (path,), lambda path: dat.parse_file_columns(path, TZ)),
+		('aggregate_columns', lambda path: (dat.parse_file_columns(path, TZ),), lambda columns: dat.aggregate_columns(cutoff, TZ, columns, None))
+	]
+
+def energyfarm_stages(path, cutoff):
+	farm = load_parser('energyfarm_datparser')
+
+	def transform(path):
+		with open(path) as csvfile:
+			props = farm.parse_file_header(csvfile)['props']
+		return (props, read_rows(path))
+
+	return [
+		('parse_file', lambda path: (path,), lambda path: farm.parse_file(path, 0, TZ)),
+		('transformProps', transform, lambda props, rows: [farm.transformProps(props, row) for row in rows]),
+		('parse_file_columns', lambda path: (path,), lambda path: farm.parse_file_columns(path, 0, TZ))
+	]
+
+PROFILE_STAGES = {
+	'terra': terra_stages,
+	'energyfarm': energyfarm_stages
+}
+
+# ----------------------------------------------------------------------
+# Resident memory of this process in bytes, 'VmRSS' for now or 'VmHWM' for the peak.
+# This returns None where /proc isn't available.
+def memory(field):
+	try:
+		with open('/proc/self/status') as status:
+			for line in status:
+				if line.startswith(field + ':'):
+					return int(line.split()[1]) * 1024
+	except IOError:
+		pass
+	return None
+
+# Start measuring the peak from the current resident memory.
+def reset_peak_memory():
+	try:
+		with open('/proc/self/clear_refs', 'w') as f:
+			f.write('5')
+		return True
+	except IOError:
+		return False
+
+# Run the stage repeat times and return the best time, with the peak memory of the first run above what was in use before it.
+def measure(setup, run, path, repeat):
+	args = setup(path)
+	seconds = []
+	peak = None
+	for x in xrange(repeat):
+		gc.collect()
+		before = memory('VmRSS')
+		measurePeak = x == 0 and before != None and reset_peak_memory()
+		start = time.time()
+		result = run(*args)
+		seconds.append(time.time() - start)
+		if measurePeak:
+			peak = max(memory('VmHWM') - before, 0)
+		del result
+	return min(seconds), peak
+
+def bench(profile, rows, columns, nanDensity, cutoff, repeat, path):
+	results = {
+		'profile': profile,
+		'rows': rows,
+		'columns': columns,
+		'nan_density': nanDensity,
+		'cutoff': cutoff,
+		'repeat': repeat,
+		'python': platform.python_version(),
+		'numpy': np.__version__,
+		'stages': {}
+	}
+	for name, setup, run in PROFILE_STAGES[profile](path, cutoff):
+		seconds, peak = measure(setup, run, path, repeat)
+		results['stages'][name] = {
+			'seconds': seconds,
+			'rows_per_second': rows / seconds if seconds > 0 else None,
+			'peak_memory_bytes': peak
+		}
+		print '%-20s %10.4f s %14.0f rows/s %10s MB peak' % (name, seconds, rows / seconds if seconds > 0 else 0, '-' if peak == None else '%.1f' % (peak / 1048576.0))
+	return results
+
+# Print how each stage compares with the baseline, and return the stages slower than the tolerance allows.
+def compare(results, baseline, tolerance):
+	regressions = []
+	for name, stage in sorted(results['stages'].items()):
+		if name not in baseline.get('stages', {}):
+			continue
+		ratio = stage['seconds'] / baseline['stages'][name]['seconds']
+		slower = ratio > 1 + tolerance
+		print '%-20s %6.2fx the baseline time%s' % (name, ratio, ' REGRESSION' if slower else '')
+		if slower:
+			regressions.append(name)
+	return regressions
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Benchmark the TOA5 parsers on a synthetic file.')
+	parser.add_argument('--profile', choices=sorted(PROFILE_STAGES.keys()), default='terra', help='station profile to benchmark (default is terra)')
+	parser.add_argument('--rows', type=int, default=86400, help='records in the synthetic file (default is 86400)')
+	parser.add_argument('--columns', type=int, default=None, help='data columns, the station ones cut down or padded with extra ones')
+	parser.add_argument('--nan', dest='nan_density', type=float, default=0.01, help='share of missing values (default is 0.01)')
+	parser.add_argument('--aggregation', dest='cutoff', type=int, default=300, help='seconds aggregated into one datapoint (default is 300)')
+	parser.add_argument('--repeat', type=int, default=3, help='runs of each stage, the best one is reported (default is 3)')
+	parser.add_argument('--input', help='benchmark this TOA5 file instead of a synthetic one')
+	parser.add_argument('--output', help='write the results as JSON to this file')
+	parser.add_argument('--baseline', help='compare with the results of an earlier run')
+	parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='slowdown against the baseline reported as a regression (default is %s)' % DEFAULT_TOLERANCE)
+	args = parser.parse_args()
+
+	path = args.input
+	if path == None:
+		fd, path = tempfile.mkstemp(suffix='.dat')
+		os.close(fd)
+		generate(path, args.rows, args.profile, args.columns, args.nan_density)
+	else:
+		with open(path) as f:
+			args.rows = sum(1 for line in f if line.strip() != '') - 4
+
+	try:
+		results = bench(args.profile, args.rows, args.columns, args.nan_density, args.cutoff, max(args.repeat, 1), path)
+	finally:
+		if args.input == None:
+			os.remove(path)
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=2, sort_keys=True)
+
+	if args.baseline:
+		with open(args.baseline) as f:
+			regressions = compare(results, json.load(f), args.tolerance)
+		if len(regressions) > 0:
+			sys.exit(1)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+"""
+fakeclowder.py
+
+Local stand-in for the Clowder and Geostreams endpoints the extractors call:
+sensors, streams, datapoints (one at a time and bulk) and file and dataset
+metadata. Responses can be slowed down and datapoint requests made to fail,
+and every request is counted and timed, for load testing the extractors
+without a real Clowder instance.
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import random
+import re
+import SocketServer
+import threading
+import time
+import urlparse
+
+
+class FakeClowder(object):
+	def __init__(self, latency = 0, jitter = 0, errorRate = 0, bulk = True):
+		# Seconds added to every response, plus up to jitter more.
+		self.latency = latency
+		self.jitter = jitter
+		# Share of datapoint requests answered with 503.
+		self.errorRate = errorRate
+		# Whether the bulk datapoint endpoint exists.
+		self.bulk = bulk
+
+		self.lock = threading.Lock()
+		self.nextId = 1
+		self.sensors = {}
+		self.streams = {}
+		# stream id -> datapoints created
+		self.datapoints = {}
+		# (resource type, id) -> metadata
+		self.metadata = {}
+		# endpoint -> seconds taken by each request
+		self.timings = {}
+		# endpoint -> response status -> count
+		self.statuses = {}
+
+	def newId(self):
+		with self.lock:
+			id = self.nextId
+			self.nextId += 1
+		return id
+
+	def record(self, endpoint, status, seconds):
+		with self.lock:
+			self.timings.setdefault(endpoint, []).append(seconds)
+			counts = self.statuses.setdefault(endpoint, {})
+			counts[status] = counts.get(status, 0) + 1
+
+	def datapointCount(self):
+		with self.lock:
+			return sum(self.datapoints.values())
+
+	# Request counts, statuses and latency percentiles of each endpoint.
+	def stats(self):
+		with self.lock:
+			timings = dict((endpoint, sorted(seconds)) for endpoint, seconds in self.timings.items())
+			statuses = dict((endpoint, dict(counts)) for endpoint, counts in self.statuses.items())
+		return dict((endpoint, {
+			'requests': len(seconds),
+			'statuses': statuses[endpoint],
+			'p50': percentile(seconds, 50),
+			'p95': percentile(seconds, 95),
+			'p99': percentile(seconds, 99),
+			'max': seconds[-1]
+		}) for endpoint, seconds in timings.items())
+
+	def reset(self):
+		with self.lock:
+			self.timings = {}
+			self.statuses = {}
+
+	# Answer a request, and return the status and the body to send back.
+	def handle(self, method, path, query, body):
+		match = re.match(r'^/api/(files|datasets)/([^/]+)/metadata\.jsonld$', path)
+		if match:
+			return self.handleMetadata(method, match.group(1), match.group(2), query, body)
+
+		if path in ('/api/geostreams/sensors', '/api/geostreams/streams'):
+			kind = path.split('/')[-1]
+			entries = self.sensors if kind == 'sensors' else self.streams
+			if method == 'GET':
+				name = query.get('sensor_name' if kind == 'sensors' else 'stream_name')
+				with self.lock:
+					return 200, [entry for entry in entries.values() if name == None or entry['name'] == name]
+			if method == 'POST':
+				entry = dict(body)
+				entry['id'] = self.newId()
+				with self.lock:
+					entries[entry['id']] = entry
+				return 200, {'id': entry['id']}
+
+		if path == '/api/geostreams/datapoints' and method == 'POST':
+			if random.random() < self.errorRate:
+				return 503, {'status': 'unavailable'}
+			self.addDatapoints(body.get('stream_id'), 1)
+			return 200, {'id': self.newId()}
+
+		if path == '/api/geostreams/datapoints/bulk' and method == 'POST':
+			if not self.bulk:
+				return 404, {'status': 'not found'}
+			if random.random() < self.errorRate:
+				return 503, {'status': 'unavailable'}
+			self.addDatapoints(body.get('stream_id'), len(body.get('datapoints', [])))
+			return 200, {'status': 'ok'}
+
+		return 404, {'status': 'not found'}
+
+	def handleMetadata(self, method, kind, id, query, body):
+		key = (kind, id)
+		with self.lock:
+			if method == 'GET':
+				return 200, list(self.metadata.get(key, []))
+			if method == 'POST':
+				self.metadata.setdefault(key, []).append(body)
+				return 200, {'status': 'ok'}
+			if method == 'DELETE':
+				return 200, self.metadata.pop(key, [])
+		return 404, {'status': 'not found'}
+
+	def addDatapoints(self, streamId, count):
+		with self.lock:
+			self.datapoints[str(streamId)] = self.datapoints.get(str(streamId), 0) + count
+
+def percentile(sortedValues, percent):
+	if len(sortedValues) == 0:
+		return None
+	return sortedValues[min(int(len(sortedValues) * percent / 100.0), len(sortedValues) - 1)]
+
+# Name of the endpoint a path belongs to, with IDs left out.
+def endpoint(method, path):
+	return '%s %s' % (method, re.sub(r'^/api/(files|datasets)/[^/]+/', r'/api/\1/ID/', path))
+
+
+class FakeClowderHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		self.respond('GET')
+
+	def do_POST(self):
+		self.respond('POST')
+
+	def do_DELETE(self):
+		self.respond('DELETE')
+
+	def respond(self, method):
+		start = time.time()
+		fake = self.server.fake
+		url = urlparse.urlparse(self.path)
+		query = dict(urlparse.parse_qsl(url.query))
+		length = int(self.headers.get('Content-Length', 0))
+		body = json.loads(self.rfile.read(length)) if length > 0 else None
+
+		if fake.latency > 0 or fake.jitter > 0:
+			time.sleep(fake.latency + random.uniform(0, fake.jitter))
+		status, result = fake.handle(method, url.path, query, body)
+
+		text = json.dumps(result)
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(text)))
+		self.end_headers()
+		self.wfile.write(text)
+		fake.record(endpoint(method, url.path), status, time.time() - start)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class FakeClowderServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+	def __init__(self, fake, address = ('127.0.0.1', 0)):
+		BaseHTTPServer.HTTPServer.__init__(self, address, FakeClowderHandler)
+		self.fake = fake
+
+	# URL of the server, as the extractors expect the host.
+	def url(self):
+		return 'http://%s:%s/' % self.server_address
+
+# Serve the fake Clowder from a background thread, and return the server.
+def start_server(fake, address = ('127.0.0.1', 0)):
+	server = FakeClowderServer(fake, address)
+	thread = threading.Thread(target=server.serve_forever, name='fakeclowder')
+	thread.daemon = True
+	thread.start()
+	return server
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Serve a fake Clowder and Geostreams API.')
+	parser.add_argument('--port', type=int, default=9000, help='port to listen on (default is 9000)')
+	parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+	parser.add_argument('--jitter', type=float, default=0, help='up to this many more seconds added at random')
+	parser.add_argument('--error-rate', dest='error_rate', type=float, default=0, help='share of datapoint requests failing with 503')
+	parser.add_argument('--no-bulk', dest='bulk', action='store_false', help='answer bulk datapoint requests with 404')
+	args = parser.parse_args()
+
+	fake = FakeClowder(args.latency, args.jitter, args.error_rate, args.bulk)
+	server = FakeClowderServer(fake, ('127.0.0.1', args.port))
+	print 'Serving a fake Clowder on %s' % server.url()
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		print json.dumps(fake.stats(), indent=2, sort_keys=True)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""
+load_driver.py
+
+Feeds synthetic datasets or files through the process_message of one of the
+extractors, against the fake Clowder of fakeclowder.py, and reports the
+datapoints created per second, the requests made to each endpoint and their
+latency. Extractor options that aren't the driver's own, such as
+--upload-workers, are handed to the extractor. With --concurrency, several
+messages are processed at the same time from threads, as pyclowder does
+with --num.
+
+The extractor runs as it would in production, so pyclowder has to be installed.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import Queue
+
+from toa5gen import *
+from fakeclowder import *
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+EXTRACTORS = {
+	'datparser': 'terra',
+	'energyfarm': 'energyfarm'
+}
+
+EXTRACTOR_DIRECTORIES = {
+	'datparser': 'datparser',
+	'energyfarm': 'energyfarm_datparser'
+}
+
+# The energy farm extractor finds the station in the file name.
+ENERGYFARM_STATIONS = ['CEN', 'NE', 'SE']
+
+
+# Connector handed to process_message, the extractors only use it for status messages and SSL settings.
+class LoadConnector(object):
+	ssl_verify = False
+
+	def message_process(self, resource, message):
+		logging.debug('%s: %s' % (resource.get('id'), message))
+
+	def status_update(self, status, resource, message):
+		logging.debug('%s: %s' % (resource.get('id'), message))
+
+# Load the extractor module, with the directory of its own parser first on the path.
+def load_extractor(name, extractorArgs):
+	directory = os.path.join(ROOT, EXTRACTOR_DIRECTORIES[name])
+	sys.path.insert(0, directory)
+	module = __import__('terra_met_datparser')
+
+	# The extractor reads its options from the command line.
+	sys.argv = [os.path.join(directory, 'terra_met_datparser.py')] + extractorArgs
+	extractor = module.MetDATFileParser()
+	with open(os.path.join(directory, 'extractor_info.json')) as f:
+		extractor.extractor_info = json.load(f)
+	return extractor
+
+# Write the files of one dataset, and return the resource process_message gets for it.
+def datparser_resource(directory, index, files, rows):
+	start = datetime.datetime(2017, 4, 1) + datetime.timedelta(seconds=index * files * rows)
+	resource = {
+		'id': 'dataset%s' % index,
+		'name': 'dataset%s' % index,
+		'type': 'dataset',
+		'files': [],
+		'local_paths': []
+	}
+	for x in xrange(files):
+		filename = 'WeatherStation_SecData_%s_%02d.dat' % (index, x)
+		path = os.path.join(directory, filename)
+		generate(path, rows, 'terra', start=(start + datetime.timedelta(seconds=x * rows)).strftime('%Y-%m-%d %H:%M:%S'), seed=index * files + x)
+		resource['files'].append({'id': 'file%s_%s' % (index, x), 'filename': filename})
+		resource['local_paths'].append(path)
+	return resource
+
+def energyfarm_resource(directory, index, files, rows):
+	station = ENERGYFARM_STATIONS[index % len(ENERGYFARM_STATIONS)]
+	filename = 'Energy_Farm_%s_Table15min_%s.dat' % (station, index)
+	path = os.path.join(directory, filename)
+	generate(path, rows, 'energyfarm', seed=index)
+	return {
+		'id': 'file%s' % index,
+		'name': filename,
+		'type': 'file',
+		'local_paths': [path]
+	}
+
+RESOURCES = {
+	'datparser': datparser_resource,
+	'energyfarm': energyfarm_resource
+}
+
+def report(fake, seconds, messages):
+	created = fake.datapointCount()
+	stats = fake.stats()
+	print '%s datapoints created in %.2f s, %.0f datapoints/s' % (created, seconds, created / seconds if seconds > 0 else 0)
+	print 'process_message p50 %.3f s, max %.3f s' % (percentile(sorted(messages), 50), max(messages))
+	print '%-45s %8s %10s %10s %10s  %s' % ('endpoint', 'requests', 'p50', 'p95', 'p99', 'statuses')
+	for name, stat in sorted(stats.items()):
+		print '%-45s %8s %10.4f %10.4f %10.4f  %s' % (name, stat['requests'], stat['p50'], stat['p95'], stat['p99'], json.dumps(stat['statuses'], sort_keys=True))
+	return {
+		'datapoints': created,
+		'seconds': seconds,
+		'datapoints_per_second': created / seconds if seconds > 0 else None,
+		'process_message_seconds': messages,
+		'endpoints': stats
+	}
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Load test an extractor against a fake Clowder.')
+	parser.add_argument('--extractor', choices=sorted(EXTRACTORS.keys()), default='datparser', help='extractor to run (default is datparser)')
+	parser.add_argument('--messages', type=int, default=3, help='datasets or files processed (default is 3)')
+	parser.add_argument('--files', type=int, default=23, help='files in each datparser dataset (default is 23)')
+	parser.add_argument('--rows', type=int, default=3600, help='records in each file (default is 3600)')
+	parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+	parser.add_argument('--jitter', type=float, default=0, help='up to this many more seconds added at random')
+	parser.add_argument('--error-rate', dest='error_rate', type=float, default=0, help='share of datapoint requests failing with 503')
+	parser.add_argument('--no-bulk', dest='bulk', action='store_false', help='answer bulk datapoint requests with 404')
+	parser.add_argument('--concurrency', type=int, default=1, help='messages processed at the same time (default is 1)')
+	parser.add_argument('--output', help='write the results as JSON to this file')
+	args, extractorArgs = parser.parse_known_args()
+
+	fake = FakeClowder(args.latency, args.jitter, args.error_rate, args.bulk)
+	server = start_server(fake)
+	host = server.url()
+	directory = tempfile.mkdtemp(prefix='load-')
+	try:
+		extractor = load_extractor(args.extractor, extractorArgs)
+		resources = [RESOURCES[args.extractor](directory, index, args.files, args.rows) for index in xrange(args.messages)]
+		connector = LoadConnector()
+
+		pending = Queue.Queue()
+		for resource in resources:
+			pending.put(resource)
+		messages = []
+		def work():
+			while True:
+				try:
+					resource = pending.get_nowait()
+				except Queue.Empty:
+					return
+				messageStart = time.time()
+				try:
+					extractor.process_message(connector, host, 'key', resource, {})
+				except Exception as e:
+					logging.exception('Problem processing %s : %s' % (resource['id'], e))
+				messages.append(time.time() - messageStart)
+
+		start = time.time()
+		threads = [threading.Thread(target=work, name='message-%s' % x) for x in xrange(max(args.concurrency, 1))]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		results = report(fake, time.time() - start, messages)
+	finally:
+		server.shutdown()
+		shutil.rmtree(directory, True)
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""
+toa5gen.py
+
+Writes synthetic TOA5 files like the ones the weather station loggers upload,
+for benchmarking the parsers without real data.
+"""
+
+import argparse
+import datetime
+import random
+
+# Columns of each station, as (name, unit, sample method, lowest value, highest value).
+STATION_PROFILES = {
+	# The TERRA-REF field station read by datparser, sampled every second.
+	'terra': {
+		'station': 'WeatherStation',
+		'table': 'SecData',
+		'step': 1,
+		'columns': [
+			('AirTC', 'Deg C', 'Smp', -5, 45),
+			('RH', '%', 'Smp', 5, 100),
+			('Pyro', 'W/m^2', 'Smp', 0, 1100),
+			('PAR_ref', 'umol/s/m^2', 'Smp', 0, 2200),
+			('WindDir', 'degrees', 'Smp', 0, 360),
+			('WS_ms', 'meters/second', 'Smp', 0, 15),
+			('Rain_mm_Tot', 'mm', 'Tot', 0, 2)
+		]
+	},
+	# The energy farm stations read by energyfarm_datparser, averaged every 15 minutes.
+	'energyfarm': {
+		'station': 'WeatherSE',
+		'table': 'Table15min',
+		'step': 15 * 60,
+		'columns': [
+			('AirTC_Avg', 'Deg C', 'Avg', -25, 40),
+			('RH1_Avg', '%', 'Avg', 10, 100),
+			('WindSpd_Avg', 'meters/second', 'Avg', 0, 15),
+			('WindSpd_Max', 'meters/second', 'Max', 0, 30),
+			('WindDir_Avg', 'degrees', 'Avg', 0, 360),
+			('PAR_APOGE_Avg', 'umol/s/m^2', 'Avg', 0, 2200),
+			('RAIN_Tot', 'mm', 'Tot', 0, 20),
+			('PRESSURE_Avg', 'kPa', 'Avg', 95, 102)
+		]
+	}
+}
+
+DEFAULT_START = '2017-04-01 00:00:00'
+
+# Columns of the profile, cut down or padded with extra unmapped columns to the given count.
+def profile_columns(profile, columns = None):
+	profileColumns = STATION_PROFILES[profile]['columns']
+	if columns == None:
+		return list(profileColumns)
+	extra = [('Extra_%s' % (x + 1), 'V', 'Smp', 0, 5) for x in xrange(max(columns - len(profileColumns), 0))]
+	return profileColumns[:columns] + extra
+
+# Write a TOA5 file of the given number of records.
+# nanDensity is the share of values written as "NAN", the way loggers write missing values.
+def generate(path, rows, profile = 'terra', columns = None, nanDensity = 0.01, start = DEFAULT_START, seed = 1):
+	random.seed(seed)
+	station = STATION_PROFILES[profile]
+	fields = profile_columns(profile, columns)
+	time = datetime.datetime.strptime(start, '%Y-%m-%d %H:%M:%S')
+	step = datetime.timedelta(seconds=station['step'])
+
+	with open(path, 'w') as f:
+		f.write('"TOA5","%s","CR1000","1234","CR1000.Std.29","CPU:met.CR1","1234","%s"\n' % (station['station'], station['table']))
+		f.write(','.join('"%s"' % x for x in ['TIMESTAMP', 'RECORD'] + [field[0] for field in fields]) + '\n')
+		f.write(','.join('"%s"' % x for x in ['TS', 'RN'] + [field[1] for field in fields]) + '\n')
+		f.write(','.join('"%s"' % x for x in ['', ''] + [field[2] for field in fields]) + '\n')
+		for record in xrange(rows):
+			values = [('"NAN"' if random.random() < nanDensity else '%.3f' % random.uniform(low, high)) for name, unit, method, low, high in fields]
+			f.write('"%s",%s,%s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), record, ','.join(values)))
+			time += step
+	return path
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Write a synthetic TOA5 file.')
+	parser.add_argument('path')
+	parser.add_argument('--rows', type=int, default=86400, help='records in the file (default is 86400)')
+	parser.add_argument('--profile', choices=sorted(STATION_PROFILES.keys()), default='terra', help='station the file comes from (default is terra)')
+	parser.add_argument('--columns', type=int, default=None, help='data columns, the station ones cut down or padded with extra ones')
+	parser.add_argument('--nan', dest='nan_density', type=float, default=0.01, help='share of missing values (default is 0.01)')
+	parser.add_argument('--start', default=DEFAULT_START, help='time of the first record (default is %s)' % DEFAULT_START)
+	parser.add_argument('--seed', type=int, default=1)
+	args = parser.parse_args()
+	generate(args.path, args.rows, args.profile, args.columns, args.nan_density, args.start, args.seed)
@@ -0,0 +1,67 @@
+"""
+handled.py
+
+Local index of the datasets this extractor has completed or is processing,
+kept in a SQLite file so it outlives restarts. check_message answers from it
+without asking Clowder for the dataset metadata, which it only does for
+datasets the index doesn't know. Entries expire, so a dataset whose metadata
+was removed to have it processed again is looked up again after a while.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# Seconds a completed dataset is trusted to stay completed.
+HANDLED_TTL = 6 * 60 * 60
+
+# Seconds a dataset is taken to be in progress after its processing started, in case its processing never ends.
+IN_PROGRESS_TTL = 60 * 60
+
+COMPLETED = 'completed'
+IN_PROGRESS = 'in progress'
+
+
+# One connection is shared by the connector threads, behind a lock.
+class HandledIndex(object):
+	def __init__(self, path, ttl = HANDLED_TTL, inProgressTtl = IN_PROGRESS_TTL):
+		directory = os.path.dirname(os.path.abspath(path))
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.path = path
+		self.ttls = {COMPLETED: ttl, IN_PROGRESS: inProgressTtl}
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		with self.lock, self.db:
+			self.db.execute('CREATE TABLE IF NOT EXISTS handled (host TEXT, dataset_id TEXT, status TEXT, expires REAL, PRIMARY KEY (host, dataset_id))')
+			removed = self.db.execute('DELETE FROM handled WHERE expires < ?', (time.time(),)).rowcount
+		if removed > 0:
+			logging.debug('Removed %s expired entries from the handled dataset index %s' % (removed, path))
+
+	def key(self, host, datasetId):
+		if(not host.endswith("/")):
+			host = host+"/"
+		return (host, datasetId)
+
+	# Status of the dataset, COMPLETED or IN_PROGRESS, or None if the index doesn't know it.
+	def get(self, host, datasetId):
+		with self.lock:
+			row = self.db.execute('SELECT status FROM handled WHERE host = ? AND dataset_id = ? AND expires >= ?', self.key(host, datasetId) + (time.time(),)).fetchone()
+		return None if row == None else row[0]
+
+	def put(self, host, datasetId, status):
+		with self.lock, self.db:
+			self.db.execute('INSERT OR REPLACE INTO handled VALUES (?, ?, ?, ?)', self.key(host, datasetId) + (status, time.time() + self.ttls[status]))
+
+	# Mark the dataset as in progress, unless it is already known. This returns whether it was marked.
+	def claim(self, host, datasetId):
+		with self.lock, self.db:
+			self.db.execute('DELETE FROM handled WHERE host = ? AND dataset_id = ? AND expires < ?', self.key(host, datasetId) + (time.time(),))
+			return self.db.execute('INSERT OR IGNORE INTO handled VALUES (?, ?, ?, ?)', self.key(host, datasetId) + (IN_PROGRESS, time.time() + self.ttls[IN_PROGRESS])).rowcount > 0
+
+	# Forget the dataset, so the next check looks it up again.
+	def remove(self, host, datasetId):
+		with self.lock, self.db:
+			self.db.execute('DELETE FROM handled WHERE host = ? AND dataset_id = ?', self.key(host, datasetId))
@@ -0,0 +1,107 @@
+"""
+idcache.py
+
+Process-wide cache of Geostreams sensor and stream IDs, keyed by host and name.
+Entries expire after a TTL. Concurrent misses for the same name wait for a
+single lookup, and creation if there is none, instead of each making their
+own requests.
+"""
+
+import logging
+import sys
+import threading
+import time
+
+# Seconds a cached ID is trusted before it is looked up again.
+ID_CACHE_TTL = 60 * 60
+
+
+class IdCache(object):
+	def __init__(self, ttl = ID_CACHE_TTL):
+		self.ttl = ttl
+		self.lock = threading.Lock()
+		# (kind, host, name) -> (id, expiry time)
+		self.entries = {}
+		# (kind, host, name) -> lookup in progress
+		self.lookups = {}
+		self.warmedHosts = set()
+
+	def key(self, kind, host, name):
+		if(not host.endswith("/")):
+			host = host+"/"
+		return (kind, host, name)
+
+	# Get the ID of the named sensor or stream, calling lookup() only if it isn't cached.
+	# lookup() returns the ID, or None if there is no such sensor or stream. None isn't cached.
+	# When lookup() finds none, create() is called if given, and returns the ID of the one it made or None.
+	# Concurrent misses wait for the single lookup and creation, and get its ID or raise its error.
+	def get(self, kind, host, name, lookup, create = None):
+		key = self.key(kind, host, name)
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry != None and entry[1] > time.time():
+				return entry[0]
+			pending = self.lookups.get(key)
+			leader = pending == None
+			if leader:
+				pending = {'done': threading.Event(), 'id': None, 'error': None}
+				self.lookups[key] = pending
+
+		if not leader:
+			# Someone else is already looking it up.
+			pending['done'].wait()
+			if pending['error'] != None:
+				raise pending['error'][0], pending['error'][1], pending['error'][2]
+			return pending['id']
+
+		try:
+			pending['id'] = lookup()
+			if pending['id'] == None and create != None:
+				pending['id'] = create()
+		except:
+			pending['error'] = sys.exc_info()
+			raise
+		finally:
+			with self.lock:
+				del self.lookups[key]
+			pending['done'].set()
+
+		if pending['id'] != None:
+			self.put(kind, host, name, pending['id'])
+		elif entry != None:
+			logging.info('%s "%s" is no longer on %s' % (kind, name, host))
+			self.invalidate(kind, host, name)
+		return pending['id']
+
+	def put(self, kind, host, name, id):
+		key = self.key(kind, host, name)
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry != None and entry[0] != id:
+				logging.info('%s "%s" on %s changed from %s to %s' % (kind, name, host, entry[0], id))
+			self.entries[key] = (id, time.time() + self.ttl)
+
+	def invalidate(self, kind, host, name):
+		with self.lock:
+			self.entries.pop(self.key(kind, host, name), None)
+
+	# Fill the cache for a host from listing() the first time it is seen.
+	# listing() returns (kind, name, id) tuples.
+	def warm(self, host, listing):
+		host = self.key(None, host, None)[1]
+		with self.lock:
+			if host in self.warmedHosts:
+				return
+			self.warmedHosts.add(host)
+		try:
+			entries = listing()
+		except Exception as e:
+			logging.warning('Problem listing sensors and streams of %s : %s' % (host, e))
+			with self.lock:
+				self.warmedHosts.discard(host)
+			return
+		for kind, name, id in entries:
+			self.put(kind, host, name, id)
+
+# Shared by every message handled by this process.
+ID_CACHE = IdCache()
@@ -0,0 +1,72 @@
+"""
+ledger.py
+
+Local SQLite ledger of the datapoints created in Geostreams, keyed by stream,
+start and end time and a hash of the datapoint content. When a message is
+processed again after a failure, the datapoints that were already created
+are found in the ledger and not posted a second time.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# Seconds an entry is kept in the ledger.
+LEDGER_RETENTION = 90 * 24 * 60 * 60
+
+# Keys looked up in one query, under the SQLite limit on parameters.
+LEDGER_QUERY_SIZE = 200
+
+
+# One connection is shared by the upload threads, behind a lock.
+class UploadLedger(object):
+	def __init__(self, path, retention = LEDGER_RETENTION):
+		directory = os.path.dirname(os.path.abspath(path))
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.path = path
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		with self.lock, self.db:
+			self.db.execute('CREATE TABLE IF NOT EXISTS datapoints (stream_id TEXT, start_time TEXT, end_time TEXT, hash TEXT, created REAL, PRIMARY KEY (stream_id, start_time, end_time, hash))')
+			self.db.execute('CREATE INDEX IF NOT EXISTS datapoints_hash ON datapoints (hash)')
+			removed = self.db.execute('DELETE FROM datapoints WHERE created < ?', (time.time() - retention,)).rowcount
+		if removed > 0:
+			logging.info('Removed %s expired entries from the upload ledger %s' % (removed, path))
+
+	# Key of a datapoint: its stream, start and end time, and a hash of everything in it.
+	def key(self, record):
+		return (str(record.get('stream_id')), record.get('start_time'), record.get('end_time'), hashlib.sha1(json.dumps(record, sort_keys=True)).hexdigest())
+
+	# Split the records into the ones already created and the ones that aren't.
+	def partition(self, records):
+		keys = [self.key(record) for record in records]
+		found = set()
+		with self.lock:
+			for x in xrange(0, len(keys), LEDGER_QUERY_SIZE):
+				hashes = [key[3] for key in keys[x:x + LEDGER_QUERY_SIZE]]
+				query = 'SELECT stream_id, start_time, end_time, hash FROM datapoints WHERE hash IN (%s)' % ','.join('?' * len(hashes))
+				found.update(tuple(row) for row in self.db.execute(query, hashes))
+
+		created = []
+		missing = []
+		for key, record in zip(keys, records):
+			(created if key in found else missing).append(record)
+		return created, missing
+
+	# Record datapoints as created.
+	def add(self, records):
+		if len(records) == 0:
+			return
+		now = time.time()
+		rows = [self.key(record) + (now,) for record in records]
+		with self.lock, self.db:
+			self.db.executemany('INSERT OR REPLACE INTO datapoints VALUES (?, ?, ?, ?, ?)', rows)
+
+	def close(self):
+		with self.lock:
+			self.db.close()
@@ -0,0 +1,189 @@
+"""
+outbox.py
+
+Durable outbox of datapoints waiting to be posted to Geostreams. Messages
+append their datapoints to a local SQLite file and move on, and a drainer
+thread posts them in batches, keeping the ones that fail for a later attempt.
+Datapoints stay in the file until they are created, across restarts and
+Geostreams outages.
+
+The file holds the key of each host, so it is created readable by its owner only.
+"""
+
+import collections
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import requests
+
+from uploader import *
+from metrics import METRICS
+
+# Datapoints taken out of the outbox at a time.
+OUTBOX_DRAIN_SIZE = 1000
+
+# Seconds the drainer waits when there is nothing to post.
+OUTBOX_INTERVAL = 5
+
+# Longest wait in seconds before a datapoint that failed is tried again.
+OUTBOX_MAX_BACKOFF = 10 * 60
+
+
+# One connection is shared by the extractor and the drainer, behind a lock.
+class Outbox(object):
+	def __init__(self, path):
+		directory = os.path.dirname(os.path.abspath(path))
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		if not os.path.exists(path):
+			os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0600))
+		self.path = path
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		with self.lock, self.db:
+			self.db.execute('CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, host TEXT, key TEXT, stream_id TEXT, record TEXT, attempts INTEGER DEFAULT 0, next_attempt REAL DEFAULT 0)')
+			self.db.execute('CREATE INDEX IF NOT EXISTS outbox_next_attempt ON outbox (next_attempt)')
+
+	# Add datapoints to post. They are on disk once this returns.
+	def append(self, host, key, records):
+		if len(records) == 0:
+			return
+		rows = [(host, key, str(record.get('stream_id')), json.dumps(record)) for record in records]
+		with self.lock, self.db:
+			self.db.executemany('INSERT INTO outbox (host, key, stream_id, record) VALUES (?, ?, ?, ?)', rows)
+		METRICS.set('extractor_outbox_depth', self.depth())
+
+	# Number of datapoints waiting.
+	def depth(self):
+		with self.lock:
+			return self.db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+	# The oldest datapoints due for an attempt, as (id, host, key, record, attempts).
+	def take(self, limit = OUTBOX_DRAIN_SIZE):
+		with self.lock:
+			rows = self.db.execute('SELECT id, host, key, record, attempts FROM outbox WHERE next_attempt <= ? ORDER BY id LIMIT ?', (time.time(), limit)).fetchall()
+		return [(rowId, host, key, json.loads(record), attempts) for rowId, host, key, record, attempts in rows]
+
+	def remove(self, rowIds):
+		with self.lock, self.db:
+			self.db.executemany('DELETE FROM outbox WHERE id = ?', [(rowId,) for rowId in rowIds])
+
+	# Try the datapoints again after a wait that doubles with every attempt.
+	def defer(self, entries):
+		rows = []
+		for rowId, attempts in entries:
+			delay = min(UPLOAD_BACKOFF * (2 ** attempts), OUTBOX_MAX_BACKOFF) * random.uniform(0.5, 1.5)
+			rows.append((attempts + 1, time.time() + delay, rowId))
+		with self.lock, self.db:
+			self.db.executemany('UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ?', rows)
+
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+# ----------------------------------------------------------------------
+# Posts the datapoints of an outbox from a background thread, in the order they were added.
+# Datapoints that fail with transient errors are tried again later, and the ones the server refuses are dropped.
+# Only one drainer should run on an outbox.
+class OutboxDrainer(object):
+	def __init__(self, outbox, batchSize = BULK_BATCH_SIZE, interval = OUTBOX_INTERVAL, ledger = None):
+		self.outbox = outbox
+		self.batchSize = batchSize
+		self.interval = interval
+		self.ledger = ledger
+		self.session = requests.Session()
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self.run, name='outbox')
+		self.thread.daemon = True
+
+	def start(self):
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.stopped.set()
+		self.thread.join()
+
+	def run(self):
+		while not self.stopped.is_set():
+			try:
+				removed = self.drain()
+			except Exception as e:
+				logging.exception('Problem draining the outbox %s : %s' % (self.outbox.path, e))
+				removed = 0
+			METRICS.set('extractor_outbox_depth', self.outbox.depth())
+			# Wait when there was nothing to post, or when nothing could be, as during an outage.
+			if removed == 0:
+				self.stopped.wait(self.interval)
+
+	# Make one attempt at the datapoints due, and return how many were removed from the outbox.
+	def drain(self):
+		removed = 0
+		uploaders = {}
+		for batch in self.batches(self.outbox.take()):
+			host, key = batch[0][1], batch[0][2]
+			if (host, key) not in uploaders:
+				uploaders[(host, key)] = DatapointUploader(host, key, self.batchSize, self.session)
+			removed += self.send(uploaders[(host, key)], batch)
+		return removed
+
+	# Split the entries into batches of one host, key and stream each, in the order they were added within a stream.
+	def batches(self, entries):
+		streams = collections.OrderedDict()
+		for entry in entries:
+			streams.setdefault((entry[1], entry[2], entry[3].get('stream_id')), []).append(entry)
+		for stream in streams.values():
+			for x in xrange(0, len(stream), self.batchSize):
+				yield stream[x:x + self.batchSize]
+
+	# Post a batch, and return how many of its datapoints were removed from the outbox.
+	def send(self, uploader, batch):
+		# Entries of the records, which come back as the same objects.
+		entries = dict((id(entry[3]), entry) for entry in batch)
+		records = [entry[3] for entry in batch]
+		skipped = []
+		if self.ledger != None:
+			skipped, records = self.ledger.partition(records)
+		succeeded, rejected, retry = uploader.upload_batch(records) if len(records) > 0 else ([], [], [])
+		if self.ledger != None:
+			self.ledger.add(succeeded)
+
+		done = skipped + succeeded + rejected
+		self.outbox.remove([entries[id(record)][0] for record in done])
+		self.outbox.defer([(entries[id(record)][0], entries[id(record)][4]) for record in retry])
+
+		METRICS.inc('extractor_outbox_drained_total', len(succeeded), result='created')
+		METRICS.inc('extractor_outbox_drained_total', len(skipped), result='skipped')
+		METRICS.inc('extractor_outbox_drained_total', len(rejected), result='rejected')
+		METRICS.inc('extractor_datapoints_failed_total', len(rejected))
+		if len(rejected) > 0:
+			logging.error('%s datapoints of stream %s refused, dropped from the outbox' % (len(rejected), batch[0][3].get('stream_id')))
+		if len(retry) > 0:
+			logging.warning('%s datapoints of stream %s left in the outbox for a later attempt' % (len(retry), batch[0][3].get('stream_id')))
+		return len(done)
+
+# ----------------------------------------------------------------------
+# Stands in for an UploadPool, adding the datapoints submitted to the outbox instead of posting them.
+# close() returns the counts of an upload, with every datapoint 'queued'.
+class OutboxUploads(object):
+	def __init__(self, outbox, host, key):
+		self.outbox = outbox
+		self.host = host
+		self.key = key
+		self.summary = newSummary()
+
+	def submit(self, records):
+		self.outbox.append(self.host, self.key, records)
+		self.summary['queued'] += len(records)
+
+	def close(self):
+		return self.summary
+
+	# Datapoints already in the outbox are posted anyway, there is nothing to stop.
+	def abort(self):
+		return self.summary
@@ -0,0 +1,117 @@
+"""
+parsecache.py
+
+Local disk cache of parsed TOA5 files, keyed by a hash of the file content
+and of the parser version, so a file that is processed again isn't decoded
+again. Columns are stored as .npz files, and the least recently used ones are
+removed once the cache grows past its size limit.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+# Directory holding the cached files.
+PARSE_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'datparser-cache')
+
+# Bytes of cached files kept before the least recently used ones are removed.
+PARSE_CACHE_SIZE = 512 * 1024 * 1024
+
+# Bytes of a file hashed at a time.
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Prefix of the arrays holding properties in a cached file.
+PROPERTY_PREFIX = 'property_'
+
+
+# The cache only holds its settings, so it can be handed to the processes parsing files.
+# Every process opens the files itself, and writes are atomic renames so they don't see each other's partial files.
+class ParseCache(object):
+	def __init__(self, directory = PARSE_CACHE_DIR, maxSize = PARSE_CACHE_SIZE):
+		self.directory = directory
+		self.maxSize = maxSize
+
+	# Key of the parsed file, from its content and anything else the parsed columns depend on.
+	def key(self, filepath, *extra):
+		digest = hashlib.sha1()
+		with open(filepath, 'rb') as f:
+			while True:
+				block = f.read(HASH_BLOCK_SIZE)
+				if len(block) == 0:
+					break
+				digest.update(block)
+		for value in extra:
+			digest.update('\0' + str(value))
+		return digest.hexdigest()
+
+	def path(self, key):
+		return os.path.join(self.directory, key + '.npz')
+
+	# Get the columns cached for the key, or None if there aren't any.
+	def get(self, key):
+		path = self.path(key)
+		try:
+			with np.load(path) as data:
+				columns = {
+					'station_name': data['station_name'].item(),
+					'timestamp': data['timestamp'],
+					'properties': dict((name[len(PROPERTY_PREFIX):], data[name]) for name in data.files if name.startswith(PROPERTY_PREFIX))
+				}
+		except (IOError, OSError):
+			return None
+		except Exception as e:
+			logging.warning('Problem reading cached columns %s : %s' % (path, e))
+			return None
+
+		# Mark it as recently used.
+		try:
+			os.utime(path, None)
+		except OSError:
+			pass
+		return columns
+
+	# Cache the columns for the key, then remove old files if the cache is too large.
+	def put(self, key, columns):
+		arrays = {
+			'station_name': np.array(columns['station_name']),
+			'timestamp': columns['timestamp']
+		}
+		for name, column in columns['properties'].items():
+			arrays[PROPERTY_PREFIX + name] = column
+
+		try:
+			if not os.path.isdir(self.directory):
+				os.makedirs(self.directory)
+			fd, temppath = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+			with os.fdopen(fd, 'wb') as f:
+				np.savez(f, **arrays)
+			os.rename(temppath, self.path(key))
+		except (IOError, OSError) as e:
+			logging.warning('Problem caching columns in %s : %s' % (self.directory, e))
+			return
+		self.evict()
+
+	# Remove the least recently used files until the cache fits in its size.
+	def evict(self):
+		entries = []
+		for name in os.listdir(self.directory):
+			if not name.endswith('.npz'):
+				continue
+			try:
+				stat = os.stat(os.path.join(self.directory, name))
+			except OSError:
+				continue
+			entries.append((stat.st_mtime, stat.st_size, name))
+
+		total = sum(size for mtime, size, name in entries)
+		for mtime, size, name in sorted(entries):
+			if total <= self.maxSize:
+				break
+			try:
+				os.remove(os.path.join(self.directory, name))
+			except OSError:
+				pass
+			total -= size
@@ -1,14 +1,29 @@
 #!/usr/bin/python
 
-import math
+import collections
+import calendar
 import datetime
 import dateutil.parser
 import dateutil.tz
 import csv
 import json
+import logging
+import itertools
+import multiprocessing
+import numpy as np
 
 DEBUG = True
 
+# Number of records parsed at a time by iter_columns.
+COLUMN_CHUNK_SIZE = 10000
+
+# Version of the parsed columns, change it when parsing changes how they come out.
+# Cached columns of another version are not used.
+PARSER_VERSION = 1
+
+# Processes parsing files at the same time in parse_files_columns, one per core by default.
+PARSE_WORKERS = multiprocessing.cpu_count()
+
 def void():
 	pass
 def log(x):
@@ -27,32 +42,143 @@ def ISOTimeString2TimeStamp(timeStr):
 	isoStartTime = datetime.datetime(1970, 1, 1, 0, 0, 0, 0, ISO_8601_UTC_MEAN)
 	return int((time - isoStartTime).total_seconds())
 
+# Offset of the given timezone from UTC, in seconds.
+def utcOffsetSeconds(tz):
+	offset = tz.utcoffset(None)
+	return 0 if offset == None else int(offset.total_seconds())
+
+# Decoder for the "YYYY-MM-DD HH:MM:SS" logger times found in TOA5 files.
+# Records are written in order, so the epoch of the date part is cached and only the time of day is parsed.
+class TimestampDecoder(object):
+	def __init__(self, utc_offset = ISO_8601_UTC_MEAN):
+		self.offsetSeconds = utcOffsetSeconds(utc_offset)
+		self.tzname = utc_offset.tzname(None)
+		self.date = None
+		self.dateTimestamp = None
+
+	# Convert the given logger time to timestamps in seconds.
+	def timestamp(self, timeStr):
+		if len(timeStr) != 19 or timeStr[10] != ' ' or timeStr[13] != ':' or timeStr[16] != ':':
+			raise ValueError('Unsupported time "%s".' % timeStr)
+		date = timeStr[:10]
+		if date != self.date:
+			self.dateTimestamp = calendar.timegm(datetime.datetime.strptime(date, '%Y-%m-%d').timetuple()) - self.offsetSeconds
+			self.date = date
+		return self.dateTimestamp + int(timeStr[11:13]) * 3600 + int(timeStr[14:16]) * 60 + int(timeStr[17:19])
+
+	# Convert the given logger time to an ISO time string.
+	def isoformat(self, timeStr):
+		return timeStr[:10] + 'T' + timeStr[11:] + self.tzname
+
 def tempUnit2K(value, unit):
-	if unit == 'Deg C':
-		return value + 273.15
-	elif unit == 'Deg F':
-		return (value + 459.67) * 5 / 9
-	elif unit == 'Deg K':
-		return value
-	else:
-		raise ValueError('Unsupported unit "%s".' % unit)
+	return unitConverter(unit, 'air_temperature')(value)
 
 def relHumidUnit2Percent(value, unit):
-	if unit == '%':
-		return value
-	else:
-		raise ValueError('Unsupported unit "%s".' % unit)
+	return unitConverter(unit, 'relative_humidity')(value)
 
 def speedUnit2MeterPerSecond(value, unit):
-	if unit == 'meters/second':
-		return value
+	return unitConverter(unit, 'wind_speed')(value)
+
+def identity(value):
+	return value
+
+# Spell a TOA5 unit the same way however the logger program wrote it, e.g. 'Deg C' and 'degC', or 'W/m^2' and 'W/m2'.
+def normalizeUnit(unit):
+	unit = unit.strip().lower().replace(' ', '')
+	return unit.replace(u'\u00b2', '2').replace('^2', '2').replace(u'\u00b5', 'u').replace(u'\u03bc', 'u')
+
+# Conversions from a TOA5 unit to the unit each CF standard name is reported in, keyed by (normalized unit, standard name).
+# They work on single values as well as on whole NumPy columns.
+UNIT_CONVERSIONS = {}
+
+def registerUnits(standardName, units, convert):
+	for unit in units:
+		UNIT_CONVERSIONS[(normalizeUnit(unit), standardName)] = convert
+
+# Units that are a multiple of the unit of their standard name, keyed as UNIT_CONVERSIONS, so they can be rescaled to one another.
+UNIT_SCALES = {}
+
+def registerScale(standardName, units, scale):
+	registerUnits(standardName, units, identity if scale == 1 else lambda value: value * scale)
+	for unit in units:
+		UNIT_SCALES[(normalizeUnit(unit), standardName)] = scale
+
+# Standard names posted in the unit their streams have always had, the one of the files so far, instead of the unit of the standard name.
+# Converting them would mix units within a stream. A file in another unit is rescaled to the unit of the stream.
+FILE_UNITS = {
+	'surface_downwelling_shortwave_flux_in_air': 'W/m^2',
+	'surface_downwelling_photosynthetic_photon_flux_in_air': 'umol/s/m^2',
+	'wind_to_direction': 'degrees',
+	'precipitation_rate': 'mm'
+}
+
+# Units without a conversion that were warned about, as (unit, standard name).
+UNCONVERTED_UNITS = set()
+
+# Resolve the conversion of the given unit to a standard name once, so it isn't looked up again for every value.
+# Units without a conversion are passed through as they are, with a warning the first time.
+def unitConverter(unit, standardName):
+	if standardName in FILE_UNITS:
+		convert = streamUnitConverter(unit, standardName, FILE_UNITS[standardName])
 	else:
-		raise ValueError('Unsupported unit "%s".' % unit)
+		convert = UNIT_CONVERSIONS.get((normalizeUnit(unit), standardName))
+	if convert == None:
+		if (unit, standardName) not in UNCONVERTED_UNITS:
+			UNCONVERTED_UNITS.add((unit, standardName))
+			logging.warning('No conversion of unit "%s" for %s, values are kept as they are.' % (unit, standardName))
+		return identity
+	return convert
+
+# Conversion of the given unit to the one of the stream, or None if they aren't multiples of the same unit.
+def streamUnitConverter(unit, standardName, streamUnit):
+	if normalizeUnit(unit) == normalizeUnit(streamUnit):
+		return identity
+	scale = UNIT_SCALES.get((normalizeUnit(unit), standardName))
+	streamScale = UNIT_SCALES.get((normalizeUnit(streamUnit), standardName))
+	if scale == None or streamScale == None:
+		return None
+	return lambda value: value * (float(scale) / streamScale)
+
+# K
+registerUnits('air_temperature', ['Deg C', 'C'], lambda value: value + 273.15)
+registerUnits('air_temperature', ['Deg F', 'F'], lambda value: (value + 459.67) * 5 / 9)
+registerUnits('air_temperature', ['Deg K', 'K'], identity)
+# %
+registerScale('relative_humidity', ['%', 'percent'], 1)
+# m/s
+registerScale('wind_speed', ['meters/second', 'm/s', 'm s-1'], 1)
+registerScale('wind_speed', ['mph', 'miles/hour'], 0.44704)
+registerScale('wind_speed', ['km/h', 'kph'], 1 / 3.6)
+registerScale('wind_speed', ['knots', 'kt'], 1852 / 3600.0)
+# Degrees clockwise from north.
+registerScale('wind_to_direction', ['degrees', 'deg', 'Deg'], 1)
+# W/m^2
+registerScale('surface_downwelling_shortwave_flux_in_air', ['W/m^2', 'W/m2', 'W m-2', 'Watts/meter^2'], 1)
+registerScale('surface_downwelling_shortwave_flux_in_air', ['kW/m^2', 'kW m-2'], 1000)
+# umol/m^2/s
+registerScale('surface_downwelling_photosynthetic_photon_flux_in_air', ['umol/s/m^2', 'umol/m^2/s', 'umol m-2 s-1'], 1)
+registerScale('surface_downwelling_photosynthetic_photon_flux_in_air', ['mmol/s/m^2', 'mmol/m^2/s', 'mmol m-2 s-1'], 1000)
+# mm over the record interval
+registerScale('precipitation_rate', ['mm'], 1)
+registerScale('precipitation_rate', ['in', 'inches'], 25.4)
+# Pa
+registerScale('air_pressure', ['Pa'], 1)
+registerScale('air_pressure', ['hPa', 'mbar', 'mb'], 100)
+registerScale('air_pressure', ['kPa'], 1000)
+registerScale('air_pressure', ['inHg'], 3386.389)
+registerScale('air_pressure', ['mmHg'], 133.322)
 
 def extractXFactor(magnitude, degreeFromNorth):
-	return magnitude * math.sin(math.radians(degreeFromNorth));
+	return magnitude * np.sin(np.radians(degreeFromNorth));
 def extractYFactor(magnitude, degreeFromNorth):
-	return magnitude * math.cos(math.radians(degreeFromNorth));
+	return magnitude * np.cos(np.radians(degreeFromNorth));
+
+# Quantities derived from others, as (standard names of the inputs, derivation).
+# The inputs are converted to the units of their standard names first.
+DERIVED_QUANTITIES = {
+	'eastward_wind': (['wind_speed', 'wind_to_direction'], extractXFactor),
+	'northward_wind': (['wind_speed', 'wind_to_direction'], extractYFactor)
+}
 
 STATION_GEOMETRY = {
 	'type': 'Point',
@@ -73,38 +199,21 @@ STATION_GEOMETRY = {
 # 'WS_ms': 'wind_speed',
 # 'Rain_mm_Tot': 'precipitation_rate'
 
-# Each mapping function can decide to return one or multiple tuple, so leave the list to them.
+# Each TOA5 column can map to one or multiple properties, as (property, input columns) tuples.
+# A property that is one of the DERIVED_QUANTITIES is derived from its input columns, any other is read from its only input column.
+# The inputs are converted with UNIT_CONVERSIONS from the units in the file header, see HeaderPlan.
 PROP_MAPPING = {
-	'AirTC': lambda d: [(
-		'air_temperature',
-		tempUnit2K(float(d['value']), d['meta']['unit'])
-	)],
-	'RH': lambda d: [(
-		'relative_humidity',
-		relHumidUnit2Percent(float(d['value']), d['meta']['unit'])
-	)],
-	'Pyro': lambda d: [(
-		'surface_downwelling_shortwave_flux_in_air',
-		float(d['value'])
-	)],
-	'PAR_ref': lambda d: [(
-		'surface_downwelling_photosynthetic_photon_flux_in_air',
-		float(d['value'])
-	)],
+	'AirTC': [('air_temperature', ['AirTC'])],
+	'RH': [('relative_humidity', ['RH'])],
+	'Pyro': [('surface_downwelling_shortwave_flux_in_air', ['Pyro'])],
+	'PAR_ref': [('surface_downwelling_photosynthetic_photon_flux_in_air', ['PAR_ref'])],
 	# If Wind Direction is present, split into speed east and speed north it if we can find Wind Speed.
-	'WindDir': lambda d: [
-		('eastward_wind', extractXFactor(float(d['record']['WS_ms']), float(d['value']))),
-		('northward_wind', extractYFactor(float(d['record']['WS_ms']), float(d['value'])))
+	'WindDir': [
+		('eastward_wind', ['WS_ms', 'WindDir']),
+		('northward_wind', ['WS_ms', 'WindDir'])
 	],
-	# If Wind Speed is present, process it if we can find Wind Direction.
-	'WS_ms': lambda d: [(
-		'wind_speed',
-		speedUnit2MeterPerSecond(float(d['value']), d['meta']['unit'])
-	)],
-	'Rain_mm_Tot': lambda d: [(
-		'precipitation_rate',
-		float(d['value'])
-	)]
+	'WS_ms': [('wind_speed', ['WS_ms'])],
+	'Rain_mm_Tot': [('precipitation_rate', ['Rain_mm_Tot'])]
 }
 
 # Aggregation functions for each property.
@@ -119,65 +228,144 @@ PROP_AGGREGATE = {
 	'precipitation_rate': sum
 }
 
+# Compiled plans by header signature, so every file with the same columns and units shares one.
+HEADER_PLANS = {}
+
+# The TOA5 header compiled into the steps that turn a raw row into properties.
+# Only the columns needed by PROP_MAPPING are read, by index, with their unit conversions resolved up front.
+class HeaderPlan(object):
+	def __init__(self, names, props):
+		self.names = names
+		# Indexes of the columns read from each row.
+		self.columns = []
+		# (property, position of the input in the values read, conversion) for properties read from one column.
+		self.single = []
+		# (property, positions of the inputs in the values read, conversions, derivation) for derived ones.
+		self.derived = []
+
+		positions = {}
+		for name in names:
+			if name not in PROP_MAPPING:
+				continue
+			for propName, inputs in PROP_MAPPING[name]:
+				# Records can't be converted without every input, the file fails as it did before the plans.
+				missing = [column for column in inputs if column not in props]
+				if len(missing) > 0:
+					raise ValueError('Column %s needed for %s is missing.' % (', '.join(missing), propName))
+				if propName in DERIVED_QUANTITIES:
+					standardNames, derive = DERIVED_QUANTITIES[propName]
+				else:
+					standardNames, derive = [propName], None
+				converters = [unitConverter(props[column]['unit'], standardName) for column, standardName in zip(inputs, standardNames)]
+				for column in inputs:
+					if column not in positions:
+						positions[column] = len(self.columns)
+						self.columns.append(names.index(column))
+				if derive == None:
+					self.single.append((propName, positions[inputs[0]], converters[0]))
+				else:
+					self.derived.append((propName, [positions[column] for column in inputs], converters, derive))
+
+	# Convert a raw row, as a list of values, into properties.
+	def properties(self, row):
+		return self.convert([float(row[index]) for index in self.columns])
+
+	# Convert whole float64 columns, as given by a ColumnRecord, into property columns.
+	def column_properties(self, record):
+		return self.convert([record[self.names[index]] for index in self.columns])
+
+	def convert(self, values):
+		newProps = dict([(propName, convert(values[position])) for propName, position, convert in self.single])
+		for propName, positions, converters, derive in self.derived:
+			newProps[propName] = derive(*[convert(values[position]) for position, convert in zip(positions, converters)])
+		return newProps
+
+# Get the compiled plan for the given columns and their metadata.
+def header_plan(names, props):
+	signature = tuple((name, props[name]['unit']) for name in names)
+	plan = HEADER_PLANS.get(signature)
+	if plan == None:
+		plan = HeaderPlan(names, props)
+		HEADER_PLANS[signature] = plan
+	return plan
+
 def transformProps(propMetaDict, propValDict):
-	newProps = []
-	for propName in propValDict:
-		if propName in PROP_MAPPING:
-			newProps += PROP_MAPPING[propName]({
-				'meta': propMetaDict[propName],
-				'value': propValDict[propName],
-				'record': propValDict
-			})
-	return dict(newProps)
+	names = [propName for propName in propValDict if propName in propMetaDict]
+	return header_plan(names, propMetaDict).properties([propValDict[propName] for propName in names])
 
 def parse_file_header_line(linestr):
 	return map(lambda x: json.loads(x), str(linestr).split(','))
 
+# Read the 4 TOA5 header lines from the file and describe its columns.
+# The file position is left at the first data row.
+def parse_file_header(csvfile):
+	# First line is always the header.
+	# @see {@link https://www.manualslib.com/manual/538296/Campbell-Cr9000.html?page=41#manual}
+	header_lines = [
+		csvfile.readline()
+	]
+
+	file_format, station_name, logger_model, logger_serial, os_version, dld_file, dld_sig, table_name = parse_file_header_line(header_lines[0])
+
+	if file_format != 'TOA5':
+		raise ValueError('Unsupported format "%s".' % file_format)
+
+	# For TOA5, there are in total 4 header lines.
+	# @see {@link https://www.manualslib.com/manual/538296/Campbell-Cr9000.html?page=43#manual}
+	while (len(header_lines) < 4):
+		header_lines.append(csvfile.readline())
+
+	prop_names = parse_file_header_line(header_lines[1])
+	prop_units = parse_file_header_line(header_lines[2])
+	prop_sample_method = parse_file_header_line(header_lines[3])
+
+	# Associate the above lists.
+	props = dict()
+	for x in xrange(len(prop_names)):
+		props[prop_names[x]] = {
+			'title': prop_names[x],
+			'unit': prop_units[x],
+			'sample_method': prop_sample_method[x]
+		}
+	# [DEBUG] Print the property details if needed.
+	#print json.dumps(props)
+
+	return {
+		'station_name': station_name,
+		'table_name': table_name,
+		'names': prop_names,
+		'units': prop_units,
+		'sample_methods': prop_sample_method,
+		'props': props
+	}
+
 # ----------------------------------------------------------------------
-# Parse the CSV file and return a list of dictionaries.
-def parse_file(filepath, utc_offset = ISO_8601_UTC_MEAN):
-	results = []
+# Parse the CSV file and yield the dictionary of each record as it is read.
+def iter_records(filepath, utc_offset = ISO_8601_UTC_MEAN):
 	with open(filepath) as csvfile:
-		# First line is always the header.
-		# @see {@link https://www.manualslib.com/manual/538296/Campbell-Cr9000.html?page=41#manual}
-		header_lines = [
-			csvfile.readline()
-		]
-
-		file_format, station_name, logger_model, logger_serial, os_version, dld_file, dld_sig, table_name = parse_file_header_line(header_lines[0])
-
-		if file_format != 'TOA5':
-			raise ValueError('Unsupported format "%s".' % file_format)
-
-		# For TOA5, there are in total 4 header lines.
-		# @see {@link https://www.manualslib.com/manual/538296/Campbell-Cr9000.html?page=43#manual}
-		while (len(header_lines) < 4):
-			header_lines.append(csvfile.readline())
-
-		prop_names = parse_file_header_line(header_lines[1])
-		prop_units = parse_file_header_line(header_lines[2])
-		prop_sample_method = parse_file_header_line(header_lines[3])
-
-		# Associate the above lists.
-		props = dict()
-		for x in xrange(len(prop_names)):
-			props[prop_names[x]] = {
-				'title': prop_names[x],
-				'unit': prop_units[x],
-				'sample_method': prop_sample_method[x]
-			}
-		# [DEBUG] Print the property details if needed.
-		#print json.dumps(props)
+		header = parse_file_header(csvfile)
+		props = header['props']
+		prop_names = header['names']
 
-		reader = csv.DictReader(csvfile, fieldnames=prop_names)
+		decoder = TimestampDecoder(utc_offset)
+		plan = header_plan(prop_names, props)
+		timeIndex = prop_names.index('TIMESTAMP')
+		reader = csv.reader(csvfile)
 		for row in reader:
-			timestamp = datetime.datetime.strptime(row['TIMESTAMP'], '%Y-%m-%d %H:%M:%S').isoformat() + utc_offset.tzname(None)
+			if len(row) == 0:
+				continue
+			timestamp = decoder.isoformat(row[timeIndex])
+			epoch = decoder.timestamp(row[timeIndex])
 			newResult = {
 				# @type {string}
 				'start_time': timestamp,
 				# @type {string}
 				'end_time': timestamp,
-				'properties': transformProps(props, row),
+				# @type {int}
+				'start_timestamp': epoch,
+				# @type {int}
+				'end_timestamp': epoch,
+				'properties': plan.properties(row),
 				# @type {string}
 				'type': 'Feature',
 				'geometry': STATION_GEOMETRY
@@ -188,9 +376,168 @@ def parse_file(filepath, utc_offset = ISO_8601_UTC_MEAN):
 # 				'units': prop_units,
 # 				'sample_method': prop_sample_method
 # 			}
-			results.append(newResult)
+			yield newResult
+
+# Parse the CSV file and return a list of dictionaries.
+def parse_file(filepath, utc_offset = ISO_8601_UTC_MEAN):
+	return list(iter_records(filepath, utc_offset))
+
+# Raw text columns of a TOA5 file, converted to float64 arrays on first access.
+class ColumnRecord(dict):
+	def __init__(self, names, rawColumns):
+		dict.__init__(self)
+		self.names = names
+		self.rawColumns = rawColumns
+
+	def __missing__(self, name):
+		column = np.array(self.rawColumns[self.names.index(name)], dtype=np.float64)
+		self[name] = column
+		return column
+
+# Convert a column of "YYYY-MM-DD HH:MM:SS" logger times to epoch seconds.
+def parse_timestamp_column(values, utc_offset):
+	return np.array(values, dtype='datetime64[s]').astype(np.int64) - utcOffsetSeconds(utc_offset)
+
+# ----------------------------------------------------------------------
+# Parse the CSV file into columns.
+# This returns a dictionary with an int64 array of epoch seconds in 'timestamp'
+# and a float64 array for each mapped property in 'properties'.
+def parse_file_columns(filepath, utc_offset = ISO_8601_UTC_MEAN):
+	with open(filepath) as csvfile:
+		header = parse_file_header(csvfile)
+		rows = list(csv.reader(csvfile))
+	return parse_rows_columns(header, rows, utc_offset)
+
+# Parse the CSV file and yield columns of at most chunkSize records at a time.
+# Memory use is bounded by the chunk size rather than by the size of the file.
+def iter_columns(filepath, utc_offset = ISO_8601_UTC_MEAN, chunkSize = COLUMN_CHUNK_SIZE):
+	with open(filepath) as csvfile:
+		header = parse_file_header(csvfile)
+		reader = csv.reader(csvfile)
+		while True:
+			rows = list(itertools.islice(reader, chunkSize))
+			if len(rows) == 0:
+				break
+			yield parse_rows_columns(header, rows, utc_offset)
+
+# Time of the first record in the CSV file, or None if it has no records.
+def file_start_time(filepath, utc_offset = ISO_8601_UTC_MEAN):
+	with open(filepath) as csvfile:
+		parse_file_header(csvfile)
+		for line in csvfile:
+			if line.strip() != '':
+				return TimestampDecoder(utc_offset).timestamp(json.loads(line.split(',')[0]))
+	return None
+
+# Everything other than the file content that decides how its columns come out.
+def parser_signature(utc_offset):
+	return (PARSER_VERSION, repr(sorted(PROP_MAPPING.items())), repr(sorted(UNIT_CONVERSIONS.keys())), repr(sorted(FILE_UNITS.items())), utc_offset.utcoffset(None))
+
+# Parse the CSV file into columns, unless they are in the cache already.
+# The cache is a ParseCache, or None to always parse the file.
+def cached_parse_file_columns(filepath, utc_offset = ISO_8601_UTC_MEAN, cache = None):
+	if cache == None:
+		return parse_file_columns(filepath, utc_offset)
+
+	key = cache.key(filepath, *parser_signature(utc_offset))
+	columns = cache.get(key)
+	if columns == None:
+		columns = parse_file_columns(filepath, utc_offset)
+		cache.put(key, columns)
+	else:
+		debug_log('Using cached columns of %s' % filepath)
+	return columns
+
+def parse_file_columns_task(args):
+	return cached_parse_file_columns(*args)
+
+# Parse several CSV files into columns with a pool of processes, and yield (filepath, columns) in the order of their first records.
+# The files after the one being yielded are parsed in the meantime, so parsing all of them takes about as long as the largest one.
+# At most the given number of workers are parsed ahead, so memory stays bounded by that many files however many there are.
+# A pool given is used as it is and left running, so messages handled at the same time can share one.
+# Otherwise a pool of the given number of workers is made for these files.
+def parse_files_columns(filepaths, utc_offset = ISO_8601_UTC_MEAN, workers = PARSE_WORKERS, cache = None, pool = None):
+	starts = [(file_start_time(filepath, utc_offset), filepath) for filepath in filepaths]
+	# Files without records go first, they don't matter to the order.
+	ordered = [filepath for start, filepath in sorted(starts, key=lambda x: (x[0] != None, x[0]))]
+
+	if (pool == None and workers <= 1) or len(ordered) <= 1:
+		for filepath in ordered:
+			yield filepath, cached_parse_file_columns(filepath, utc_offset, cache)
+		return
+
+	ownPool = pool == None
+	if ownPool:
+		pool = multiprocessing.Pool(min(workers, len(ordered)))
+	try:
+		# A sliding window of files, the next one is only started once the oldest is taken.
+		waiting = iter(ordered)
+		pending = collections.deque()
+		for filepath in itertools.islice(waiting, max(workers, 1)):
+			pending.append((filepath, pool.apply_async(parse_file_columns_task, [(filepath, utc_offset, cache)])))
+		while len(pending) > 0:
+			filepath, result = pending.popleft()
+			columns = result.get()
+			for nextFilepath in itertools.islice(waiting, 1):
+				pending.append((nextFilepath, pool.apply_async(parse_file_columns_task, [(nextFilepath, utc_offset, cache)])))
+			yield filepath, columns
+	finally:
+		if ownPool:
+			pool.terminate()
+			pool.join()
+
+# Turn the raw rows of a TOA5 file into columns.
+def parse_rows_columns(header, rows, utc_offset):
+	rawColumns = zip(*rows) if len(rows) > 0 else [()] * len(header['names'])
+	return parse_raw_columns(header, rawColumns, utc_offset)
+
+# Turn the raw text columns of a TOA5 file into parsed columns.
+def parse_raw_columns(header, rawColumns, utc_offset):
+	prop_names = header['names']
+	record = ColumnRecord(prop_names, rawColumns)
+
+	return {
+		'station_name': header['station_name'],
+		'timestamp': parse_timestamp_column(rawColumns[prop_names.index('TIMESTAMP')], utc_offset),
+		'properties': header_plan(prop_names, header['props']).column_properties(record)
+	}
+
+# Present parsed columns as the list of record dictionaries returned by parse_file.
+def columns_to_records(columns, utc_offset = ISO_8601_UTC_MEAN):
+	offset = utc_offset.utcoffset(None)
+	tzname = utc_offset.tzname(None)
+	properties = [(key, column.tolist()) for key, column in columns['properties'].items()]
+
+	results = []
+	for index, value in enumerate(columns['timestamp'].tolist()):
+		timestamp = (datetime.datetime.utcfromtimestamp(value) + offset).isoformat() + tzname
+		results.append({
+			'start_time': timestamp,
+			'end_time': timestamp,
+			'start_timestamp': value,
+			'end_timestamp': value,
+			'properties': dict((key, column[index]) for key, column in properties),
+			'type': 'Feature',
+			'geometry': STATION_GEOMETRY
+		})
 	return results
 
+# Keep the rows of parsed columns after the given time in seconds.
+def columns_after(columns, previousTime):
+	later = columns['timestamp'] > previousTime
+	selected = dict(columns)
+	selected['timestamp'] = columns['timestamp'][later]
+	selected['properties'] = dict((key, column[later]) for key, column in columns['properties'].items())
+	return selected
+
+# Get the start or end time of a parsed record in seconds.
+# Records from parse_file carry them already, others fall back to parsing the ISO time string.
+def recordTimeStamp(record, which):
+	key = which + '_timestamp'
+	if key in record:
+		return record[key]
+	return ISOTimeString2TimeStamp(record[which + '_time'])
+
 # ----------------------------------------------------------------------
 # Aggregate the list of parsed results.
 # The aggregation starts with the input data and no state given.
@@ -198,6 +545,8 @@ def parse_file(filepath, utc_offset = ISO_8601_UTC_MEAN):
 # which should be fed back into the function to continue or end the aggregation.
 # If there's no more data to input, provide None and the aggregation will stop.
 # When aggregation ended, the state package returned should be None to indicate that.
+# The state package holds the running aggregates of the open bin, see new_bin_state,
+# so its size depends on the number of properties and not on the number of records.
 # Note: data has to be sorted by time.
 # Note: cutoffSize is in seconds.
 def aggregate(cutoffSize, tz, inputData, state):
@@ -205,142 +554,440 @@ def aggregate(cutoffSize, tz, inputData, state):
 	result = {
 		'packages': [],
 		# In case the input data does nothing, inherit the state first.
-		'state': None if state == None else dict(state)
+		'state': None if state == None else copy_bin_state(state)
 	}
 
 	# The aggregation ends when no more data is available. (inputData is None)
-	# In which case it needs to recover leftover data in the state package.
+	# In which case it needs to wrap up the open bin in the state package.
 	if inputData == None:
 		debug_log('Ending aggregation...')
 
-		# The aggregation is ending, try recover leftover data from the state.
-		if state == None:
-			# There is nothing to do.
-			pass
-		else:
-			# Recover leftover data from state.
-
-			data = state['leftover']
-
-			if len(data) == 0:
-				# There is nothing to recover.
-				pass
-			else:
-				# Aggregate leftover data.
-				# Assume leftover data never contain more data than the cutoff allows.
-
-				startTime = state['starttime']
-				# Use the latest date in the data entries.
-				# Assuming the data is always sorted, the last one should be the latest.
-				endTime = ISOTimeString2TimeStamp(data[-1]['end_time'])
+		if state != None and state['count'] > 0:
+			# Use the latest date in the data entries.
+			result['packages'].append(accumulated_package(state, tz, state['endtime']))
 
-				newPackage = aggregate_chunk(data, tz, startTime, endTime)
-				if newPackage != None:
-					result['packages'].append(newPackage)
-
-			# Mark state with None to indicate the aggregation is done.
-			result['state'] = None
+		# Mark state with None to indicate the aggregation is done.
+		result['state'] = None
 	else:
 		debug_log('Aggregating...')
 
-		data = inputData
-
 		# More data is provided, continue aggregation.
 		if state == None:
 			debug_log('Fresh start...')
 			# There is no previous state, starting afresh.
+			if len(inputData) == 0:
+				return result
 
 			# Use the earliest date in the input data entries.
 			# Assuming the input data is always sorted, the first one should be the earliest.
-			startTime = ISOTimeString2TimeStamp(data[0]['start_time'])
-
+			state = new_bin_state(recordTimeStamp(inputData[0], 'start'))
 		else:
 			debug_log('Continuing...')
 			# Resume aggregation from a previous state.
+			state = result['state']
+
+		# Find the nearest cut-off point.
+		startTime = state['starttime']
+		endTimeCutoff = startTime - startTime % cutoffSize + cutoffSize
+
+		for record in inputData:
+			endTime = recordTimeStamp(record, 'end')
+			if endTime >= endTimeCutoff:
+				# Cutoff reached, aggregate the open bin.
+				if state['count'] > 0:
+					result['packages'].append(accumulated_package(state, tz, endTimeCutoff))
+				# Bins without data are skipped, the next one is where this record falls.
+				startTime = endTime - endTime % cutoffSize
+				endTimeCutoff = startTime + cutoffSize
+				state = new_bin_state(startTime)
+			accumulate_record(state, record, endTime)
 
-			startTime = state['starttime']
-			# Left over data should be part of the data being processed.
-			data = state['leftover'] + inputData
-
-		startIndex = 0
-
-		# Keep aggregating until all the data is consumed.
-		while startIndex < len(data):
-			# Find the nearest cut-off point.
-			endTimeCutoff = startTime - startTime % cutoffSize + cutoffSize
-			# Scan the input data to find the portion that fits in the cutoff.
-			endIndex = startIndex
-			while endIndex < len(data) and ISOTimeString2TimeStamp(data[endIndex]['end_time']) < endTimeCutoff:
-				endIndex += 1
-
-			# If everything fits in the cutoff, there may be more data in the next run.
-			# Otherwise, these data should be aggregated.
-			if endIndex >= len(data):
-				# End of data reached, but cutoff is not.
-				# Save everything into state.
-				result['state'] = {
-					'starttime': startTime,
-					'leftover': data[startIndex:]
-				}
-			else:
-				# Cutoff reached.
-				# Aggregate this chunk.
-				newPackage = aggregate_chunk(data[startIndex:endIndex], tz, startTime, endTimeCutoff)
-				if newPackage != None:
-					result['packages'].append(newPackage)
-
-			# Update variables for the next loop.
-			startTime = endTimeCutoff
-			startIndex = endIndex
-
-		# The above loop should end with some chunks aggregated into result['packages'],
-		# with the last chunk saved in result['state']['leftover']
+		# The open bin may get more data in the next run.
+		result['state'] = state
 
 	return result
 
-# Helper function for aggregating a chunk of data.
-# @param {timestamp} startTime
+# The state package of an open bin.
+#   'starttime'  start time of the package
+#   'endtime'    time of the last record in it
+#   'count'      number of records in it
+#   'properties' {property: {'count', 'sum', 'min', 'max'}}, the running aggregates of each property
+def new_bin_state(startTime):
+	return {
+		'starttime': startTime,
+		'endtime': startTime,
+		'count': 0,
+		'properties': {}
+	}
+
+def copy_bin_state(state):
+	state = dict(state)
+	state['properties'] = dict((key, dict(partials)) for key, partials in state['properties'].items())
+	return state
+
+def accumulate_record(state, record, endTime):
+	state['count'] += 1
+	state['endtime'] = endTime
+	accumulate_props(state['properties'], record['properties'])
+
+# Add the values of one record to the running aggregates of each property.
+def accumulate_props(accumulators, properties):
+	for key, value in properties.items():
+		# Properties start with "_" shouldn't be processed.
+		# If there is no aggregation function, ignore the property.
+		if key.startswith('_') or key not in PROP_AGGREGATE:
+			continue
+		partials = accumulators.get(key)
+		if partials == None:
+			accumulators[key] = {'count': 1, 'sum': value, 'min': value, 'max': value}
+			continue
+		partials['count'] += 1
+		partials['sum'] += value
+		# Comparisons with NaN are false, so once NaN is in it stays, as it does in the sum.
+		# A state from BinLevel.getState only has the partials its aggregation function needs.
+		if 'min' in partials and (value != value or value < partials['min']):
+			partials['min'] = value
+		if 'max' in partials and (value != value or value > partials['max']):
+			partials['max'] = value
+
+def accumulated_props(accumulators):
+	return dict(
+		(key, PARTIAL_AGGREGATE[PROP_AGGREGATE[key]][1](partials, partials['count']))
+		for key, partials in accumulators.items()
+	)
+
+# Helper function for packaging the aggregates of a bin.
 # @param {timestamp} endTime
-def aggregate_chunk(dataChunk, tz, startTime, endTime):
-	if len(dataChunk) == 0:
-		# There is nothing to aggregate.
-		return None
-	else:
-		# Prepare the list of properties for aggregation.
-		propertiesList = map(lambda x: x['properties'], dataChunk)
+def accumulated_package(state, tz, endTime):
+	return {
+		'start_time': datetime.datetime.fromtimestamp(state['starttime'], tz).isoformat(),
+		'end_time': datetime.datetime.fromtimestamp(endTime, tz).isoformat(),
+		'properties': accumulated_props(state['properties']),
+		'type': 'Point',
+		'geometry': STATION_GEOMETRY
+	}
 
-		return {
+def aggregateProps(propertiesList):
+	accumulators = {}
+	for properties in propertiesList:
+		accumulate_props(accumulators, properties)
+	return accumulated_props(accumulators)
+
+# Reductions of the partial aggregates of consecutive bins into those of the bins they make up.
+PARTIAL_REDUCE = {
+	'count': np.add.reduceat,
+	'sum': np.add.reduceat,
+	'min': np.minimum.reduceat,
+	'max': np.maximum.reduceat
+}
+
+# Partial aggregates kept for each aggregation function, and how its value comes out of them and the count of values.
+# Partial aggregates combine, so larger bins can be built from smaller ones instead of from records.
+# The count of values is kept for every property, as 'count'.
+PARTIAL_AGGREGATE = {
+	avg: (['sum'], lambda partials, count: partials['sum'] / count),
+	sum: (['sum'], lambda partials, count: partials['sum']),
+	min: (['min'], lambda partials, count: partials['min']),
+	max: (['max'], lambda partials, count: partials['max'])
+}
+
+# Gather parsed records into columns, the reverse of columns_to_records.
+def records_to_columns(records):
+	keys = set()
+	for record in records:
+		keys.update(record['properties'])
+
+	return {
+		'timestamp': np.array([recordTimeStamp(record, 'end') for record in records], dtype=np.int64),
+		'properties': dict(
+			(key, np.array([record['properties'].get(key, np.nan) for record in records], dtype=np.float64))
+			for key in keys if not key.startswith('_')
+		)
+	}
+
+# ----------------------------------------------------------------------
+# Bins are columns of partial aggregates:
+#   'timestamp' time of the first record of each bin
+#   'last'      time of the last record of each bin
+#   'count'     number of records in each bin
+#   'properties' {property: {partial: values}}, for each property with an aggregation function, with the 'count' of its values
+# Bins that are complete also have their bin id in 'bin', and their package times in 'start' and 'end'.
+
+# Parsed columns as bins of one record each.
+def columns_to_bins(columns):
+	timestamps = columns['timestamp']
+	properties = {}
+	for key, column in columns['properties'].items():
+		# Properties start with "_" shouldn't be processed.
+		# If there is no aggregation function, ignore the property.
+		if key.startswith('_') or key not in PROP_AGGREGATE:
+			continue
+		properties[key] = dict((partial, column) for partial in PARTIAL_AGGREGATE[PROP_AGGREGATE[key]][0])
+		properties[key]['count'] = np.ones(len(timestamps), dtype=np.int64)
+	return {
+		'timestamp': timestamps,
+		'last': timestamps,
+		'count': np.ones(len(timestamps), dtype=np.int64),
+		'properties': properties
+	}
+
+# Reduce consecutive bins into larger ones.
+# @param {list} binStarts The index where each larger bin starts.
+def merge_bins(bins, binStarts):
+	binStarts = np.asarray(binStarts)
+	ends = np.append(binStarts[1:], len(bins['timestamp'])) - 1
+	return {
+		'timestamp': bins['timestamp'][binStarts],
+		'last': bins['last'][ends],
+		'count': np.add.reduceat(bins['count'], binStarts),
+		'properties': dict(
+			(key, dict((partial, PARTIAL_REDUCE[partial](values, binStarts)) for partial, values in partials.items()))
+			for key, partials in bins['properties'].items()
+		)
+	}
+
+# Join two sets of bins, the first one being earlier in time. Only the columns of the first one are kept.
+# A property only one of them has, as when a file header changes, has no values in the bins of the other.
+def concat_bins(first, second):
+	bins = dict((key, np.concatenate((first[key], second[key]))) for key in first if key != 'properties')
+	bins['properties'] = {}
+	for key in set(first['properties']) | set(second['properties']):
+		firstPartials = first['properties'].get(key) or empty_partials(key, len(first['timestamp']))
+		secondPartials = second['properties'].get(key) or empty_partials(key, len(second['timestamp']))
+		bins['properties'][key] = dict((partial, np.concatenate((firstPartials[partial], secondPartials[partial]))) for partial in firstPartials)
+	return bins
+
+# Partial aggregates of a property for bins without any of its values.
+EMPTY_PARTIALS = {
+	'count': 0,
+	'sum': 0.0,
+	'min': np.inf,
+	'max': -np.inf
+}
+
+def empty_partials(key, length):
+	partials = PARTIAL_AGGREGATE[PROP_AGGREGATE[key]][0] + ['count']
+	return dict((partial, np.full(length, EMPTY_PARTIALS[partial], dtype=np.int64 if partial == 'count' else np.float64)) for partial in partials)
+
+# Select a range of bins.
+def slice_bins(bins, start, end):
+	sliced = dict((key, values[start:end]) for key, values in bins.items() if key != 'properties')
+	sliced['properties'] = dict(
+		(key, dict((partial, values[start:end]) for partial, values in partials.items()))
+		for key, partials in bins['properties'].items()
+	)
+	return sliced
+
+# Turn complete bins into packages.
+def bins_to_packages(bins, tz):
+	if bins == None:
+		return []
+
+	properties = {}
+	counts = {}
+	for key, partials in bins['properties'].items():
+		# Bins without values of the property leave it out, the division by their count of 0 doesn't matter.
+		with np.errstate(divide='ignore', invalid='ignore'):
+			properties[key] = PARTIAL_AGGREGATE[PROP_AGGREGATE[key]][1](partials, partials['count']).tolist()
+		counts[key] = partials['count'].tolist()
+
+	packages = []
+	for index, (startTime, endTime) in enumerate(zip(bins['start'].tolist(), bins['end'].tolist())):
+		packages.append({
 			'start_time': datetime.datetime.fromtimestamp(startTime, tz).isoformat(),
 			'end_time': datetime.datetime.fromtimestamp(endTime, tz).isoformat(),
-			'properties': aggregateProps(propertiesList),
+			'properties': dict((key, values[index]) for key, values in properties.items() if counts[key][index] > 0),
 			'type': 'Point',
 			'geometry': STATION_GEOMETRY
+		})
+	return packages
+
+# ----------------------------------------------------------------------
+# One resolution of the aggregation, merging bins given in time order into bins of cutoffSize seconds.
+# Bin ids are ts // cutoffSize. The open bin is kept merged into one, so it takes the same space however many records it has.
+# The first bin starts at the time of its first record, and the last one, returned by close(), ends at the time of its last record.
+# Note: cutoffSize is in seconds.
+class BinLevel(object):
+	def __init__(self, cutoffSize):
+		self.cutoffSize = cutoffSize
+		self.startTime = None
+		self.openBin = None
+		self.open = None
+
+	# Add bins, and return the bins they complete, or None.
+	def feed(self, bins):
+		timestamps = bins['timestamp']
+		if len(timestamps) == 0:
+			return None
+		if self.startTime == None:
+			self.startTime = int(timestamps[0])
+
+		closed = []
+		binIds = timestamps // self.cutoffSize
+
+		if self.open != None:
+			# Bins at the front may belong to the open bin.
+			split = int(np.searchsorted(binIds, self.openBin, 'right'))
+			if split > 0:
+				self.open = merge_bins(concat_bins(self.open, slice_bins(bins, 0, split)), [0])
+			if split == len(timestamps):
+				return None
+			closed.append(self.flush())
+			bins = slice_bins(bins, split, None)
+			binIds = binIds[split:]
+
+		binStarts = np.append(0, np.flatnonzero(np.diff(binIds)) + 1)
+
+		# The last bin may still receive data, keep it open.
+		lastStart = int(binStarts[-1])
+		if lastStart > 0:
+			merged = merge_bins(slice_bins(bins, 0, lastStart), binStarts[:-1])
+			merged['bin'] = binIds[binStarts[:-1]]
+			merged['start'] = np.maximum(merged['bin'] * self.cutoffSize, self.startTime)
+			merged['end'] = (merged['bin'] + 1) * self.cutoffSize
+			closed.append(merged)
+		self.openBin = int(binIds[-1])
+		self.open = merge_bins(slice_bins(bins, lastStart, None), [0])
+
+		return reduce(concat_bins, closed) if len(closed) > 0 else None
+
+	# End the aggregation and return the open bin, if any. It ends at the time of its last record.
+	def close(self):
+		closed = None
+		if self.open != None:
+			closed = self.flush()
+			closed['end'] = closed['last'].copy()
+		self.startTime = None
+		self.openBin = None
+		return closed
+
+	def flush(self):
+		merged = self.open
+		self.open = None
+		merged['bin'] = np.array([self.openBin], dtype=np.int64)
+		merged['start'] = np.maximum(merged['bin'] * self.cutoffSize, self.startTime)
+		merged['end'] = (merged['bin'] + 1) * self.cutoffSize
+		return merged
+
+	# The state package of the open bin, in the form used by aggregate, or None if no bin is open.
+	# Only the partial aggregates kept for each property are in it, with the count of its values.
+	def getState(self):
+		if self.open == None:
+			return None
+		return {
+			'starttime': max(self.openBin * self.cutoffSize, self.startTime),
+			'endtime': int(self.open['last'][0]),
+			'count': int(self.open['count'][0]),
+			'properties': dict(
+				(key, dict((partial, int(values[0]) if partial == 'count' else float(values[0])) for partial, values in partials.items()))
+				for key, partials in self.open['properties'].items()
+			)
 		}
 
-def aggregateProps(propertiesList):
-	collection = {}
+	# Continue from a state package of getState or of aggregate. Only the partial aggregates kept for each property are taken.
+	def setState(self, state):
+		self.startTime = state['starttime']
+		self.openBin = state['starttime'] // self.cutoffSize
+		self.open = {
+			'timestamp': np.array([state['starttime']], dtype=np.int64),
+			'last': np.array([state['endtime']], dtype=np.int64),
+			'count': np.array([state['count']], dtype=np.int64),
+			'properties': dict(
+				(key, dict((partial, np.array([partials[partial]], dtype=np.int64 if partial == 'count' else np.float64)) for partial in PARTIAL_AGGREGATE[PROP_AGGREGATE[key]][0] + ['count']))
+				for key, partials in state['properties'].items() if key in PROP_AGGREGATE
+			)
+		}
 
-	for properties in propertiesList:
-		for key in properties:
-			# Properties start with "_" shouldn't be processed.
-			if key.startswith('_'):
-				continue
-			value = properties[key]
-			# Collect property values and save them into collection
-			if key not in collection:
-				collection[key] = [value]
-			else:
-				collection[key].append(value)
-
-	result = {}
-	for key in properties:
-		# If there is no aggregation function, ignore the property.
-		if key not in PROP_AGGREGATE:
-			continue
-		func = PROP_AGGREGATE[key]
-		result[key] = func(collection[key])
+# ----------------------------------------------------------------------
+# Incremental aggregation of parsed data into several resolutions at once.
+# Records or column chunks are given to feed() in time order. It returns {cutoffSize: packages} for the bins they close.
+# close() returns the packages of the last, partial bins.
+# Only the finest resolution is aggregated from records. The others are built from its bins,
+# so every cutoffSize has to be a multiple of the smallest one.
+# Note: cutoffSizes are in seconds.
+class Rollup(object):
+	def __init__(self, cutoffSizes, tz):
+		self.cutoffSizes = sorted(set(int(cutoffSize) for cutoffSize in cutoffSizes))
+		self.tz = tz
+		for cutoffSize in self.cutoffSizes[1:]:
+			if cutoffSize % self.cutoffSizes[0] != 0:
+				raise ValueError('Aggregation of %s seconds can\'t be built from %s second bins.' % (cutoffSize, self.cutoffSizes[0]))
+		self.levels = [BinLevel(cutoffSize) for cutoffSize in self.cutoffSizes]
 
-	return result
+	# Add records or columns, and return the packages of the bins that are complete.
+	def feed(self, data):
+		columns = data if isinstance(data, dict) else records_to_columns(list(data))
+		closed = self.levels[0].feed(columns_to_bins(columns))
+
+		packages = {self.cutoffSizes[0]: bins_to_packages(closed, self.tz)}
+		for level in self.levels[1:]:
+			packages[level.cutoffSize] = bins_to_packages(level.feed(closed) if closed != None else None, self.tz)
+		return packages
+
+	# End the aggregation and return the packages of the open bins.
+	def close(self):
+		closed = self.levels[0].close()
+
+		packages = {self.cutoffSizes[0]: bins_to_packages(closed, self.tz)}
+		for level in self.levels[1:]:
+			packages[level.cutoffSize] = bins_to_packages(level.feed(closed) if closed != None else None, self.tz) + bins_to_packages(level.close(), self.tz)
+		return packages
+
+	# The state package of each resolution, {cutoffSize: state}, with None where no bin is open.
+	def getState(self):
+		return dict((level.cutoffSize, level.getState()) for level in self.levels)
+
+	# Continue the open bins of an earlier aggregation, given as returned by getState.
+	def setState(self, states):
+		for level in self.levels:
+			if states.get(level.cutoffSize) != None:
+				level.setState(states[level.cutoffSize])
+
+# Incremental aggregation of parsed data into a single resolution, see Rollup.
+# feed() and close() return the list of packages.
+class Aggregator(Rollup):
+	def __init__(self, cutoffSize, tz, state = None):
+		Rollup.__init__(self, [cutoffSize], tz)
+		self.cutoffSize = cutoffSize
+		if state != None:
+			self.setState(state)
+
+	def feed(self, data):
+		return Rollup.feed(self, data)[self.cutoffSize]
+
+	def close(self):
+		return Rollup.close(self)[self.cutoffSize]
+
+	def getState(self):
+		return self.levels[0].getState()
+
+	def setState(self, state):
+		self.levels[0].setState(state)
+
+# ----------------------------------------------------------------------
+# Aggregate parsed columns, as returned by parse_file_columns.
+# This follows the same protocol as aggregate: feed the returned state back in,
+# and provide None as inputColumns to flush the last bin.
+# All the bins of one call are found and reduced at once, with bin ids as ts // cutoffSize.
+# Note: data has to be sorted by time.
+# Note: cutoffSize is in seconds.
+def aggregate_columns(cutoffSize, tz, inputColumns, state):
+	aggregator = Aggregator(cutoffSize, tz, state)
+
+	if inputColumns == None:
+		debug_log('Ending aggregation...')
+		# The state returned is None to indicate the aggregation is done.
+		return {
+			'packages': aggregator.close(),
+			'state': None
+		}
+
+	debug_log('Aggregating...')
+	packages = aggregator.feed(inputColumns)
+	return {
+		'packages': packages,
+		'state': aggregator.getState()
+	}
 
 if __name__ == "__main__":
 	size = 5 * 60
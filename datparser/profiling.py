@@ -0,0 +1,140 @@
+"""
+profiling.py
+
+Profiles the handling of one message: CPU time with cProfile, and memory with
+tracemalloc where this Python has it. Without tracemalloc the peak resident
+memory and the growth in live objects by type are reported instead.
+Nothing is done unless a message is asked to be profiled.
+"""
+
+import collections
+import cProfile
+import datetime
+import gc
+import json
+import logging
+import os
+import pstats
+import tempfile
+import time
+
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+# Directory the profiles of each resource are written under.
+PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'extractor-profiles')
+
+# Lines listed for the functions and allocation sites that cost the most.
+PROFILE_TOP = 30
+
+# Frames kept for each allocation traced by tracemalloc.
+TRACEMALLOC_FRAMES = 5
+
+
+# Whether the message parameters ask for the message to be profiled, with "profile": true.
+# Parameters submitted with the extraction request may come as a JSON string under 'parameters'.
+def profile_requested(parameters):
+	if not isinstance(parameters, dict):
+		return False
+	if parameters.get('profile'):
+		return True
+	submitted = parameters.get('parameters')
+	if isinstance(submitted, basestring):
+		try:
+			submitted = json.loads(submitted)
+		except ValueError:
+			return False
+	return isinstance(submitted, dict) and bool(submitted.get('profile'))
+
+# Resident memory of this process in bytes, 'VmRSS' for now or 'VmHWM' for the peak.
+# This returns None where /proc isn't available.
+def process_memory(field):
+	try:
+		with open('/proc/self/status') as status:
+			for line in status:
+				if line.startswith(field + ':'):
+					return int(line.split()[1]) * 1024
+	except IOError:
+		pass
+	return None
+
+def reset_peak_memory():
+	try:
+		with open('/proc/self/clear_refs', 'w') as f:
+			f.write('5')
+	except IOError:
+		pass
+
+def count_objects():
+	return collections.Counter(type(o).__name__ for o in gc.get_objects())
+
+
+# Profile the block of a with statement, and write what it cost to a new directory under the given one:
+#   profile.pstats   the cProfile data, for pstats or snakeviz
+#   profile.txt      the functions with the most cumulative time
+#   memory.txt       the allocation sites, or object types, that grew the most
+#   summary.json     wall time and memory use
+class MessageProfile(object):
+	def __init__(self, directory):
+		self.directory = os.path.join(directory, datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S'))
+
+	def __enter__(self):
+		gc.collect()
+		self.memoryBefore = process_memory('VmRSS')
+		reset_peak_memory()
+		if tracemalloc != None:
+			tracemalloc.start(TRACEMALLOC_FRAMES)
+			self.objectsBefore = None
+		else:
+			self.objectsBefore = count_objects()
+
+		self.profiler = cProfile.Profile()
+		self.start = time.time()
+		self.profiler.enable()
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.profiler.disable()
+		seconds = time.time() - self.start
+		try:
+			self.write(seconds)
+		except Exception as e:
+			logging.warning('Problem writing the profile to %s : %s' % (self.directory, e))
+		finally:
+			if tracemalloc != None:
+				tracemalloc.stop()
+		return False
+
+	def write(self, seconds):
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+
+		self.profiler.dump_stats(os.path.join(self.directory, 'profile.pstats'))
+		with open(os.path.join(self.directory, 'profile.txt'), 'w') as f:
+			stats = pstats.Stats(self.profiler, stream=f)
+			stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+
+		summary = {
+			'seconds': seconds,
+			'memory_before_bytes': self.memoryBefore,
+			'peak_memory_bytes': process_memory('VmHWM'),
+			'memory_after_bytes': process_memory('VmRSS')
+		}
+		with open(os.path.join(self.directory, 'memory.txt'), 'w') as f:
+			if tracemalloc != None:
+				current, peak = tracemalloc.get_traced_memory()
+				summary['traced_peak_bytes'] = peak
+				f.write('Top %s allocation sites still allocated, traced peak %s bytes\n' % (PROFILE_TOP, peak))
+				for stat in tracemalloc.take_snapshot().statistics('lineno')[:PROFILE_TOP]:
+					f.write('%s\n' % stat)
+			else:
+				growth = count_objects()
+				growth.subtract(self.objectsBefore)
+				f.write('Top %s object types by growth in live objects, tracemalloc is not available\n' % PROFILE_TOP)
+				for name, count in growth.most_common(PROFILE_TOP):
+					f.write('%10d %s\n' % (count, name))
+		with open(os.path.join(self.directory, 'summary.json'), 'w') as f:
+			json.dump(summary, f, indent=2, sort_keys=True)
+		logging.info('Profile written to %s' % self.directory)
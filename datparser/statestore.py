@@ -0,0 +1,94 @@
+"""
+statestore.py
+
+Local store of the aggregation state left open at the end of a dataset, one
+JSON file per Geostreams stream, so the next dataset of the stream continues
+its open bins instead of cutting them at the dataset boundary.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+# Writes are atomic renames, so a state file is either the old one or the new one.
+# A message holds the streams it aggregates with locked(), so messages of other streams go on at the same time.
+class StateStore(object):
+	def __init__(self, directory):
+		self.directory = directory
+		self.lock = threading.Lock()
+		self.locks = {}
+
+	def path(self, host, streamId):
+		if(not host.endswith("/")):
+			host = host+"/"
+		return os.path.join(self.directory, hashlib.sha1('%s\0%s' % (host, streamId)).hexdigest() + '.json')
+
+	# Hold the state of the streams in the block of a with statement.
+	def locked(self, host, streamIds):
+		with self.lock:
+			locks = [self.locks.setdefault(path, threading.Lock()) for path in sorted(set(self.path(host, streamId) for streamId in streamIds))]
+		return StreamLocks(locks)
+
+	# Get what was saved for the stream, or None if nothing was or it was aggregated with another cutoff.
+	# The result has the 'state' package, and the 'source' and 'source_file' of the data in it.
+	def get(self, host, streamId, cutoffSize):
+		path = self.path(host, streamId)
+		try:
+			with open(path) as f:
+				saved = json.load(f)
+		except IOError:
+			return None
+		except ValueError as e:
+			logging.warning('Problem reading aggregation state %s : %s' % (path, e))
+			return None
+
+		if saved.get('cutoff') != cutoffSize:
+			logging.warning('Ignoring aggregation state of stream %s, it was aggregated into %s second chunks' % (streamId, saved.get('cutoff')))
+			return None
+		return saved
+
+	# Save the state package of the stream, None removes it.
+	def put(self, host, streamId, cutoffSize, state, source = None, sourceFile = None):
+		path = self.path(host, streamId)
+		if state == None:
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			return
+
+		saved = {
+			'host': host,
+			'stream_id': streamId,
+			'cutoff': cutoffSize,
+			'saved': time.time(),
+			'source': source,
+			'source_file': sourceFile,
+			'state': state
+		}
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+		fd, temppath = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+		with os.fdopen(fd, 'w') as f:
+			json.dump(saved, f)
+		os.rename(temppath, path)
+
+# Takes the locks of several streams, always in the same order so two messages can't wait on each other.
+class StreamLocks(object):
+	def __init__(self, locks):
+		self.locks = locks
+
+	def __enter__(self):
+		for lock in self.locks:
+			lock.acquire()
+		return self
+
+	def __exit__(self, type, value, traceback):
+		for lock in reversed(self.locks):
+			lock.release()
+		return False
@@ -17,6 +17,8 @@ import requests
 import urllib
 import urlparse
 import logging
+import itertools
+import multiprocessing
 
 from pyclowder.extractors import Extractor
 from pyclowder.utils import CheckMessage
@@ -24,6 +26,15 @@ import pyclowder.files
 import pyclowder.datasets
 
 from parser import *
+from uploader import *
+from ledger import *
+from outbox import *
+from idcache import *
+from parsecache import *
+from statestore import *
+from handled import *
+from metrics import *
+from profiling import *
 
 
 class MetDATFileParser(Extractor):
@@ -36,9 +47,50 @@ class MetDATFileParser(Extractor):
 		self.parser.add_argument('--sensor', dest="sensor_name", type=str, nargs='?',
 								 default=('Full Field'),
 								 help="sensor name where streams and datapoints should be posted")
-		self.parser.add_argument('--aggregation', dest="agg_cutoff", type=int, nargs='?',
-								 default=(300),
-								 help="minute chunks to aggregate records into (default is 5 mins)")
+		self.parser.add_argument('--aggregation', dest="agg_cutoffs", type=int, nargs='+',
+								 default=([300]),
+								 help="second chunks to aggregate records into, each one posted to its own stream (default is 5 mins); coarser chunks are built from the smallest one and have to be multiples of it")
+		self.parser.add_argument('--upload-batch', dest="upload_batch", type=int, nargs='?',
+								 default=(BULK_BATCH_SIZE),
+								 help="datapoints posted to geostreams per bulk request (default is %s)" % BULK_BATCH_SIZE)
+		self.parser.add_argument('--upload-workers', dest="upload_workers", type=int, nargs='?',
+								 default=(UPLOAD_WORKERS),
+								 help="threads posting datapoints to geostreams (default is %s)" % UPLOAD_WORKERS)
+		self.parser.add_argument('--parse-workers', dest="parse_workers", type=int, nargs='?',
+								 default=(PARSE_WORKERS),
+								 help="processes parsing input files at the same time (default is %s)" % PARSE_WORKERS)
+		self.parser.add_argument('--parse-cache', dest="parse_cache", type=str, nargs='?',
+								 default=(PARSE_CACHE_DIR),
+								 help="directory caching parsed input files, empty to disable (default is %s)" % PARSE_CACHE_DIR)
+		self.parser.add_argument('--parse-cache-size', dest="parse_cache_size", type=int, nargs='?',
+								 default=(PARSE_CACHE_SIZE / 1024 / 1024),
+								 help="megabytes of parsed input files cached (default is %s)" % (PARSE_CACHE_SIZE / 1024 / 1024))
+		self.parser.add_argument('--aggregation-state', dest="aggregation_state", type=str, nargs='?',
+								 default=(''),
+								 help="directory keeping the bins left open at the end of each dataset, so the next dataset of the stream continues them (default is empty, the last bins of each dataset are posted as they are)")
+		self.parser.add_argument('--upload-ledger', dest="upload_ledger", type=str, nargs='?',
+								 default=(''),
+								 help="SQLite file recording the datapoints created, so they are skipped when a message is processed again (default is empty, no ledger)")
+		self.parser.add_argument('--outbox', dest="outbox", type=str, nargs='?',
+								 default=(''),
+								 help="SQLite file datapoints are written to before a background thread posts them, so they survive restarts and geostreams outages (default is empty, datapoints are posted while the message is processed)")
+		self.parser.add_argument('--handled-index', dest="handled_index", type=str, nargs='?',
+								 default=(''),
+								 help="SQLite file indexing the datasets completed or in progress, so most checks don't fetch dataset metadata (default is empty, every check fetches it)")
+		self.parser.add_argument('--handled-ttl', dest="handled_ttl", type=int, nargs='?',
+								 default=(HANDLED_TTL),
+								 help="seconds a completed dataset stays in the handled index before its metadata is checked again (default is %s)" % HANDLED_TTL)
+		self.parser.add_argument('--max-requests', dest="max_requests", type=int, nargs='?',
+								 default=(0),
+								 help="requests to clowder in flight at once across every message handled at the same time, as with --num (default is 0, no limit)")
+		self.parser.add_argument('--metrics-port', dest="metrics_port", type=int, nargs='?',
+								 default=(0),
+								 help="port serving metrics in the Prometheus text format on /metrics (default is 0, not served)")
+		self.parser.add_argument('--profile', dest="profile", action='store_true',
+								 help="profile every message with cProfile and memory snapshots, messages can also ask for it with the parameter \"profile\": true (only the extractor process is profiled, use --parse-workers 1 to include parsing)")
+		self.parser.add_argument('--profile-dir', dest="profile_dir", type=str, nargs='?',
+								 default=(PROFILE_DIR),
+								 help="directory the profiles of each resource are written under (default is %s)" % PROFILE_DIR)
 
 
 		# parse command line and load default logging configuration
@@ -50,15 +102,49 @@ class MetDATFileParser(Extractor):
 
 		# assign other arguments
 		self.sensor_name = self.args.sensor_name
-		self.agg_cutoff = self.args.agg_cutoff
+		self.agg_cutoffs = sorted(set(self.args.agg_cutoffs))
+		for cutoff in self.agg_cutoffs[1:]:
+			if cutoff % self.agg_cutoffs[0] != 0:
+				self.parser.error("aggregation of %s seconds can't be built from %s second chunks" % (cutoff, self.agg_cutoffs[0]))
+		self.upload_batch = self.args.upload_batch
+		self.upload_workers = self.args.upload_workers
+		self.upload_ledger = UploadLedger(self.args.upload_ledger) if self.args.upload_ledger else None
+		self.outbox = Outbox(self.args.outbox) if self.args.outbox else None
+		self.parse_workers = self.args.parse_workers
+		self.parse_cache = ParseCache(self.args.parse_cache, self.args.parse_cache_size * 1024 * 1024) if self.args.parse_cache else None
+		self.aggregation_state = StateStore(self.args.aggregation_state) if self.args.aggregation_state else None
+		self.handled = HandledIndex(self.args.handled_index, self.args.handled_ttl) if self.args.handled_index else None
+		# Messages handled at the same time share one pool of parsing processes.
+		# It is made before any thread is started, as it forks.
+		self.parse_pool = multiprocessing.Pool(self.parse_workers) if self.parse_workers > 1 else None
+
+		self.profile = self.args.profile
+		self.profile_dir = self.args.profile_dir
+
+		limit_requests(self.args.max_requests)
+		if self.outbox != None:
+			OutboxDrainer(self.outbox, self.upload_batch, ledger=self.upload_ledger).start()
+		if self.args.metrics_port:
+			start_metrics_server(self.args.metrics_port)
 
 	def check_message(self, connector, host, secret_key, resource, parameters):
 		# Check for expected input files before beginning processing
 		if len(get_all_files(resource)) >= 23:
+			# Most checks are answered by the local index, the dataset metadata is only fetched for datasets it doesn't know.
+			if self.handled != None:
+				handled = self.handled.get(host, resource['id'])
+				if handled != None:
+					METRICS.inc('extractor_checks_total', source='index')
+					logging.info('skipping %s, dataset already %s' % (resource['id'], handled))
+					return CheckMessage.ignore
+
+			METRICS.inc('extractor_checks_total', source='metadata')
 			md = pyclowder.datasets.download_metadata(connector, host, secret_key,
 													  resource['id'], self.extractor_info['name'])
 			for m in md:
 				if 'agent' in m and 'name' in m['agent'] and m['agent']['name'].endswith(self.extractor_info['name']):
+					if self.handled != None:
+						self.handled.put(host, resource['id'], COMPLETED)
 					logging.info('skipping %s, dataset already handled' % resource['id'])
 					return CheckMessage.ignore
 
@@ -68,72 +154,69 @@ class MetDATFileParser(Extractor):
 			return CheckMessage.ignore
 
 	def process_message(self, connector, host, secret_key, resource, parameters):
-		ISO_8601_UTC_OFFSET = dateutil.tz.tzoffset("-07:00", -7 * 60 * 60)
+		# Checks of the files added while the dataset is processed are skipped.
+		# It is only claimed once its files are downloaded, so a failed download leaves nothing to expire.
+		# Another message may have taken it since it was checked.
+		if self.handled != None and not self.handled.claim(host, resource['id']):
+			METRICS.inc('extractor_messages_total', status='skipped')
+			logging.info('skipping %s, dataset already %s' % (resource['id'], self.handled.get(host, resource['id'])))
+			return
+
+		# Count the message, and log what it and the threads uploading for it took.
+		with METRICS.collect() as counts:
+			status = 'failed'
+			try:
+				# Profiling costs nothing unless it is asked for.
+				if self.profile or profile_requested(parameters):
+					with MessageProfile(os.path.join(self.profile_dir, resource['id'])):
+						self.process_dataset(connector, host, secret_key, resource, parameters)
+				else:
+					self.process_dataset(connector, host, secret_key, resource, parameters)
+				status = 'completed'
+			finally:
+				# A dataset that failed is looked up again on its next check.
+				if self.handled != None:
+					if status == 'completed':
+						self.handled.put(host, resource['id'], COMPLETED)
+					else:
+						self.handled.remove(host, resource['id'])
+				METRICS.inc('extractor_messages_total', status=status)
+				logging.info('%s: %s' % (resource['id'], counts.summary()))
+
+	def process_dataset(self, connector, host, secret_key, resource, parameters):
 		main_coords = [ -111.974304, 33.075576, 0]
 
-		# SENSOR is Full Field by default
-		sensor_id = get_sensor_id(host, secret_key, self.sensor_name)
-		if not sensor_id:
-			sensor_id = create_sensor(host, secret_key, self.sensor_name, {
-				"type": "Point",
-				# These are a point off to the right of the field
-				"coordinates": main_coords
-			})
+		with METRICS.timer('extractor_stage_seconds', stage='streams'):
+			# Sensor and stream IDs are cached for the whole process, fill the cache the first time a host is seen.
+			ID_CACHE.warm(host, lambda: list_geostreams_ids(host, secret_key))
 
-		# STREAM is Weather Station
-		stream_name = self.sensor_name + " - Weather Station"
-		stream_id = get_stream_id(host, secret_key, stream_name)
-		if not stream_id:
-			stream_id = create_stream(host, secret_key, sensor_id, stream_name, {
+			# SENSOR is Full Field by default
+			sensor_id = get_or_create_sensor(host, secret_key, self.sensor_name, {
 				"type": "Point",
+				# These are a point off to the right of the field
 				"coordinates": main_coords
 			})
 
-		# Find input files in dataset
-		target_files = get_all_files(resource)
-		datasetUrl = urlparse.urljoin(host, 'datasets/%s' % resource['id'])
-
-		#! Files should be sorted for the aggregation to work.
-		aggregationState = None
-		lastAggregatedFile = None
+			# STREAM is Weather Station, with one more for each coarser aggregation.
+			stream_names = {}
+			stream_ids = {}
+			for cutoff in self.agg_cutoffs:
+				stream_name = self.sensor_name + " - Weather Station"
+				if cutoff != self.agg_cutoffs[0]:
+					stream_name += " (%s)" % cutoff_label(cutoff)
+				stream_id = get_or_create_stream(host, secret_key, sensor_id, stream_name, {
+					"type": "Point",
+					"coordinates": main_coords
+				})
+				stream_names[cutoff] = stream_name
+				stream_ids[cutoff] = stream_id
 
-		# Process each file and concatenate results together.
-		# To work with the aggregation process, add an extra NULL file to indicate we are done with all the files.
-		for file in (list(target_files) + [ None ]):
-			if file == None:
-				# We are done with all the files, finish up aggregation.
-				# Pass None as data into the aggregation to let it wrap up any work left.
-				records = None
-				# The file ID would be the last file processed.
-				fileId = lastAggregatedFile['id']
-			else:
-				# Add this file to the aggregation.
-				for p in resource['local_paths']:
-					if os.path.basename(p) == file['filename']:
-						filepath = p
-
-				# Parse one file and get all the records in it.
-				records = parse_file(filepath, utc_offset=ISO_8601_UTC_OFFSET)
-				fileId = file['id']
-
-			aggregationResult = aggregate(
-					cutoffSize=self.agg_cutoff,
-					tz=ISO_8601_UTC_OFFSET,
-					inputData=records,
-					state=aggregationState
-			)
-			aggregationState = aggregationResult['state']
-			aggregationRecords = aggregationResult['packages']
-
-			# Add props to each record.
-			for record in aggregationRecords:
-				record['properties']['source'] = datasetUrl
-				record['properties']['source_file'] = fileId
-
-				record['stream_id'] = str(stream_id)
-
-			upload_datapoints(host, secret_key, aggregationRecords)
-			lastAggregatedFile = file
+		# Datasets carrying aggregation state over to the next one are aggregated one at a time per stream.
+		if self.aggregation_state != None:
+			with self.aggregation_state.locked(host, stream_ids.values()):
+				self.aggregate_dataset(host, secret_key, resource, stream_ids, stream_names)
+		else:
+			self.aggregate_dataset(host, secret_key, resource, stream_ids, stream_names)
 
 		# Mark dataset as processed.
 		metadata = {
@@ -146,16 +229,163 @@ class MetDATFileParser(Extractor):
 				"extractor_id": host + "/api/extractors/" + self.extractor_info['name']
 			}
 		}
-		pyclowder.datasets.upload_metadata(connector, host, secret_key, resource['id'], metadata)
+		with METRICS.timer('extractor_stage_seconds', stage='metadata'):
+			pyclowder.datasets.upload_metadata(connector, host, secret_key, resource['id'], metadata)
+
+	# Parse, aggregate and upload the input files of the dataset to the streams of each cutoff.
+	def aggregate_dataset(self, host, secret_key, resource, stream_ids, stream_names):
+		ISO_8601_UTC_OFFSET = dateutil.tz.tzoffset("-07:00", -7 * 60 * 60)
+
+		# Find input files in dataset
+		target_files = get_all_files(resource)
+		datasetUrl = urlparse.urljoin(host, 'datasets/%s' % resource['id'])
+
+		filepaths = {}
+		for file in target_files:
+			for p in resource['local_paths']:
+				if os.path.basename(p) == file['filename']:
+					filepaths[p] = file
+
+		# Files are parsed by a pool of processes, and come back in the order of their records for the aggregation to work.
+		# Every resolution is aggregated from the same pass over the records.
+		rollup = Rollup(self.agg_cutoffs, ISO_8601_UTC_OFFSET)
+		lastAggregatedFile = None
+		# Datapoints are uploaded in the background while the files are parsed.
+		# With an outbox, they are only written to it and the drainer posts them.
+		if self.outbox != None:
+			uploads = OutboxUploads(self.outbox, host, secret_key)
+		else:
+			uploads = UploadPool(host, secret_key, self.upload_workers, self.upload_batch, ledger=self.upload_ledger)
+
+		# Bins left open by the previous dataset of each stream continue with this one.
+		saved = {}
+		if self.aggregation_state != None:
+			for cutoff in self.agg_cutoffs:
+				savedStream = self.aggregation_state.get(host, stream_ids[cutoff], cutoff)
+				if savedStream != None:
+					saved[cutoff] = savedStream
+		resumedUntil = max(savedStream['state']['endtime'] for savedStream in saved.values()) if len(saved) > 0 else None
+		# The saved bins were built from this dataset when it is processed again.
+		reprocessed = len(saved) > 0 and all(savedStream['source'] == datasetUrl for savedStream in saved.values())
+		# Whether the saved bins continue with this dataset, known from its first record.
+		resuming = True if len(saved) == 0 else None
+		skippedRows = 0
+		aggregatedRows = 0
+
+		# Process each file and concatenate results together.
+		# To work with the aggregation process, add an extra NULL file to indicate we are done with all the files.
+		# Parse time is the time spent waiting for the next parsed file.
+		parsing = parse_files_columns(filepaths.keys(), ISO_8601_UTC_OFFSET, self.parse_workers, self.parse_cache, self.parse_pool)
+		parsedFiles = METRICS.timed(parsing, 'extractor_stage_seconds', stage='parse')
+		# If anything fails, the batches still queued are dropped and the upload threads stopped.
+		try:
+			for filepath, columns in itertools.chain(parsedFiles, [ (None, None) ]):
+				if filepath == None:
+					# We are done with all the files, finish up aggregation.
+					# Pass None as data into the aggregation to let it wrap up any work left.
+					file = None
+					# The file ID would be the last file processed.
+					fileId = lastAggregatedFile['id']
+				else:
+					# Add this file to the aggregation.
+					file = filepaths[filepath]
+					fileId = file['id']
+					METRICS.inc('extractor_rows_total', len(columns['timestamp']))
+
+					# A dataset that comes in late, as when it failed before a later one was processed, has records the saved bins
+					# don't hold. It is aggregated on its own, and the saved bins are left for the dataset after them.
+					if resuming == None and len(columns['timestamp']) > 0:
+						resuming = reprocessed or columns['timestamp'].min() > resumedUntil
+						if resuming:
+							rollup.setState(dict((cutoff, savedStream['state']) for cutoff, savedStream in saved.items()))
+						else:
+							logging.warning('%s: data starts before the end of the saved aggregation, aggregating the dataset without it' % resource['id'])
+
+					# The saved bins hold every record up to their end already when the dataset is processed again,
+					# so only the later records are added.
+					if resuming and resumedUntil != None:
+						later = columns_after(columns, resumedUntil)
+						skippedRows += len(columns['timestamp']) - len(later['timestamp'])
+						columns = later
+					aggregatedRows += len(columns['timestamp'])
+
+				# Packages come out as soon as their bin closes.
+				# With a state store, the open bins are saved for the next dataset instead of closed.
+				with METRICS.timer('extractor_stage_seconds', stage='aggregate'):
+					if columns != None:
+						aggregations = rollup.feed(columns)
+					elif self.aggregation_state != None and resuming != False:
+						aggregations = {}
+					else:
+						aggregations = rollup.close()
+					aggregationRecords = label_packages(aggregations, stream_ids, datasetUrl, fileId)
+				METRICS.inc('extractor_datapoints_total', len(aggregationRecords))
+
+				# This waits while the upload queue is full.
+				with METRICS.timer('extractor_stage_seconds', stage='upload'):
+					uploads.submit(aggregationRecords)
+				lastAggregatedFile = file
+		except:
+			uploads.abort()
+			# No more files are parsed for it either.
+			parsing.close()
+			raise
+
+		if skippedRows > 0:
+			logging.warning('%s: %s records already in the saved aggregation skipped' % (resource['id'], skippedRows))
+
+		with METRICS.timer('extractor_stage_seconds', stage='upload'):
+			uploaded = uploads.close()
+		METRICS.inc('extractor_datapoints_failed_total', uploaded['failed'])
+		METRICS.inc('extractor_datapoints_skipped_total', uploaded['skipped'])
+		logging.info('%s: %s datapoints created in %s batches, %s created before, %s queued in the outbox, %s failed' % (resource['id'], uploaded['succeeded'], uploaded['batches'], uploaded['skipped'], uploaded['queued'], uploaded['failed']))
+
+		# Leave the dataset unmarked so it can be processed again.
+		# The stream may have gone away, look its ID up again next time.
+		if uploaded['failed'] > 0:
+			for stream_name in stream_names.values():
+				ID_CACHE.invalidate('stream', host, stream_name)
+			raise Exception('%s datapoints of dataset %s could not be created' % (uploaded['failed'], resource['id']))
+
+		# Save the open bins only once everything before them is posted.
+		# Without any new record, or for a dataset aggregated without them, the saved ones are left as they are.
+		if self.aggregation_state != None and resuming and aggregatedRows > 0:
+			for cutoff, state in rollup.getState().items():
+				self.aggregation_state.put(host, stream_ids[cutoff], cutoff, state, datasetUrl, fileId)
+
+# List the IDs of all sensors and streams on the host as (kind, name, id) tuples.
+def list_geostreams_ids(host, key):
+	if(not host.endswith("/")):
+		host = host+"/"
+
+	ids = []
+	for kind in ['sensor', 'stream']:
+		url = "%sapi/geostreams/%ss?key=%s" % (host, kind, key)
+		r = clowder_request('get', kind + 's', url)
+		r.raise_for_status()
+		for s in r.json():
+			if 'name' in s and 'id' in s:
+				ids.append((kind, s['name'], s['id']))
+	logging.debug("...found %s sensors and streams" % len(ids))
+	return ids
 
 # Get sensor ID from Clowder based on plot name
+# The ID is taken from the process-wide cache when possible.
 def get_sensor_id(host, key, name):
+	return ID_CACHE.get('sensor', host, name, lambda: lookup_sensor_id(host, key, name))
+
+# Get sensor ID from Clowder, creating the sensor if there is none.
+# Messages missing the cache at the same time wait for one lookup and creation, so the sensor is only made once.
+def get_or_create_sensor(host, key, name, geom):
+	return ID_CACHE.get('sensor', host, name, lambda: lookup_sensor_id(host, key, name), lambda: create_sensor(host, key, name, geom))
+
+def lookup_sensor_id(host, key, name):
 	if(not host.endswith("/")):
 		host = host+"/"
 
 	url = "%sapi/geostreams/sensors?sensor_name=%s&key=%s" % (host, name, key)
 	logging.debug("...searching for sensor : "+name)
-	r = requests.get(url)
+	r = clowder_request('get', 'sensors', url)
 	if r.status_code == 200:
 		json_data = r.json()
 		for s in json_data:
@@ -188,10 +418,11 @@ def create_sensor(host, key, name, geom):
 
 	url = "%sapi/geostreams/sensors?key=%s" % (host, key)
 	logging.info("...creating new sensor: "+name)
-	r = requests.post(url,
+	r = clowder_request('post', 'sensors', url,
 					  data=json.dumps(body),
 					  headers={'Content-type': 'application/json'})
 	if r.status_code == 200:
+		ID_CACHE.put('sensor', host, name, r.json()['id'])
 		return r.json()['id']
 	else:
 		logging.error("error creating sensor")
@@ -199,13 +430,22 @@ def create_sensor(host, key, name, geom):
 	return None
 
 # Get stream ID from Clowder based on stream name
+# The ID is taken from the process-wide cache when possible.
 def get_stream_id(host, key, name):
+	return ID_CACHE.get('stream', host, name, lambda: lookup_stream_id(host, key, name))
+
+# Get stream ID from Clowder, creating the stream if there is none.
+# Messages missing the cache at the same time wait for one lookup and creation, so the stream is only made once.
+def get_or_create_stream(host, key, sensor_id, name, geom):
+	return ID_CACHE.get('stream', host, name, lambda: lookup_stream_id(host, key, name), lambda: create_stream(host, key, sensor_id, name, geom))
+
+def lookup_stream_id(host, key, name):
 	if(not host.endswith("/")):
 		host = host+"/"
 
 	url = urlparse.urljoin(host, 'api/geostreams/streams?stream_name=%s&key=%s' % (name, key))
 	logging.debug("...searching for stream : "+name)
-	r = requests.get(url)
+	r = clowder_request('get', 'streams', url)
 	if r.status_code == 200:
 		json_data = r.json()
 		for s in json_data:
@@ -230,27 +470,17 @@ def create_stream(host, key, sensor_id, name, geom):
 
 	url = "%sapi/geostreams/streams?key=%s" % (host, key)
 	logging.info("...creating new stream: "+name)
-	r = requests.post(url,
+	r = clowder_request('post', 'streams', url,
 					  data=json.dumps(body),
 					  headers={'Content-type': 'application/json'})
 	if r.status_code == 200:
+		ID_CACHE.put('stream', host, name, r.json()['id'])
 		return r.json()['id']
 	else:
 		logging.error("error creating stream: %s" % r.status_code)
 
 	return None
 
-# Save records as JSON back to GeoStream.
-def upload_datapoints(host, key, records):
-	url = urlparse.urljoin(host, 'api/geostreams/datapoints?key=%s' % key)
-
-	for record in records:
-		headers = {'Content-type': 'application/json'}
-		r = requests.post(url, data=json.dumps(record), headers=headers)
-		if (r.status_code != 200):
-			logging.error('Problem creating datapoint : [%s] - %s' % (str(r.status_code), r.text))
-	return
-
 # Find as many expected files as possible and return the set.
 def get_all_files(resource):
 	target_files = []
@@ -267,6 +497,25 @@ def get_all_files(resource):
 
 	return target_files
 
+# Add props to the packages of each resolution, and return them all as records for the stream of their resolution.
+def label_packages(aggregations, stream_ids, source, source_file):
+	aggregationRecords = []
+	for cutoff, records in sorted(aggregations.items()):
+		for record in records:
+			record['properties']['source'] = source
+			record['properties']['source_file'] = source_file
+
+			record['stream_id'] = str(stream_ids[cutoff])
+		aggregationRecords += records
+	return aggregationRecords
+
+# Describe an aggregation cutoff in seconds, as "1 hour" or "90 seconds".
+def cutoff_label(cutoff):
+	for seconds, unit in [(86400, 'day'), (3600, 'hour'), (60, 'minute'), (1, 'second')]:
+		if cutoff % seconds == 0:
+			count = cutoff / seconds
+			return '%s %s%s' % (count, unit, '' if count == 1 else 's')
+
 def get_output_filename(raw_filename):
 	return '%s.nc' % raw_filename[:-len('_raw')]
 
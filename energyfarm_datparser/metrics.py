@@ -0,0 +1,240 @@
+"""
+metrics.py
+
+Counters and latency histograms of the extractor stages and of the requests
+made to Clowder, rendered in the Prometheus text format. They can be served
+over HTTP for Prometheus to scrape, and summarized per message in the logs
+from what the threads working on the message counted.
+"""
+
+import BaseHTTPServer
+import bisect
+import logging
+import threading
+import time
+
+# Marks the end of an iterable in Metrics.timed.
+END = object()
+
+# Upper bounds in seconds of the histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Description of each metric, shown as its HELP line.
+METRIC_HELP = {
+	'extractor_messages_total': 'Messages processed, by result.',
+	'extractor_checks_total': 'Dataset checks, by whether the handled index or the dataset metadata answered them.',
+	'extractor_rows_total': 'Records parsed from input files.',
+	'extractor_datapoints_total': 'Datapoints produced for Geostreams.',
+	'extractor_datapoints_failed_total': 'Datapoints that could not be created.',
+	'extractor_datapoints_refused_total': 'Datapoints the server refused to create, which are not tried again.',
+	'extractor_datapoints_skipped_total': 'Datapoints not posted because the upload ledger has them as created.',
+	'extractor_stage_seconds': 'Time spent in each stage of a message.',
+	'extractor_outbox_depth': 'Datapoints waiting in the outbox to be posted.',
+	'extractor_outbox_drained_total': 'Datapoints taken out of the outbox, by result.',
+	'clowder_requests_total': 'Requests made to Clowder, by endpoint and status.',
+	'clowder_request_failures_total': 'Requests to Clowder that failed, by endpoint.',
+	'clowder_request_seconds': 'Time taken by requests to Clowder, by endpoint.'
+}
+
+
+class Histogram(object):
+	def __init__(self, buckets = LATENCY_BUCKETS):
+		self.buckets = buckets
+		self.counts = [0] * len(buckets)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		index = bisect.bisect_left(self.buckets, value)
+		if index < len(self.counts):
+			self.counts[index] += 1
+		self.sum += value
+		self.count += 1
+
+
+class Metrics(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		# (name, labels) -> value, labels are sorted (name, value) tuples.
+		self.counters = {}
+		# (name, labels) -> Histogram
+		self.histograms = {}
+		# (name, labels) -> value
+		self.gauges = {}
+		# The MessageCounts each thread counts into as well, if any.
+		self.local = threading.local()
+
+	def inc(self, name, value = 1, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+		self.count(key, value)
+
+	def set(self, name, value, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			self.gauges[key] = value
+
+	def observe(self, name, seconds, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			histogram = self.histograms.get(key)
+			if histogram == None:
+				histogram = Histogram()
+				self.histograms[key] = histogram
+			histogram.observe(seconds)
+		self.count((name + '_sum', key[1]), seconds)
+
+	def count(self, key, value):
+		counts = self.collector()
+		if counts != None:
+			counts.add(key, value)
+
+	# Count what the current thread does in the block of a with statement apart, for the summary of one message.
+	def collect(self):
+		return Collecting(self, MessageCounts())
+
+	# The MessageCounts of the current thread, to attach() to the threads working on the same message.
+	def collector(self):
+		return getattr(self.local, 'counts', None)
+
+	def attach(self, counts):
+		self.local.counts = counts
+
+	# Time the block of a with statement into the named histogram.
+	def timer(self, name, **labels):
+		return Timer(self, name, labels)
+
+	# Yield the items of the iterable, timing how long each one takes to come into the named histogram.
+	def timed(self, iterable, name, **labels):
+		iterator = iter(iterable)
+		while True:
+			with self.timer(name, **labels):
+				item = next(iterator, END)
+			if item is END:
+				return
+			yield item
+
+	# Every metric in the Prometheus text format.
+	def render(self):
+		with self.lock:
+			counters = sorted(self.counters.items())
+			gauges = sorted(self.gauges.items())
+			histograms = sorted((key, (list(histogram.counts), histogram.sum, histogram.count, histogram.buckets)) for key, histogram in self.histograms.items())
+
+		lines = []
+		described = set()
+		def describe(name, kind):
+			if name not in described:
+				described.add(name)
+				if name in METRIC_HELP:
+					lines.append('# HELP %s %s' % (name, METRIC_HELP[name]))
+				lines.append('# TYPE %s %s' % (name, kind))
+
+		for (name, labels), value in counters:
+			describe(name, 'counter')
+			lines.append('%s%s %s' % (name, formatLabels(labels), value))
+		for (name, labels), value in gauges:
+			describe(name, 'gauge')
+			lines.append('%s%s %s' % (name, formatLabels(labels), value))
+		for (name, labels), (counts, total, count, buckets) in histograms:
+			describe(name, 'histogram')
+			cumulative = 0
+			for bound, bucketCount in zip(buckets, counts):
+				cumulative += bucketCount
+				lines.append('%s_bucket%s %s' % (name, formatLabels(labels + (('le', repr(float(bound))),)), cumulative))
+			lines.append('%s_bucket%s %s' % (name, formatLabels(labels + (('le', '+Inf'),)), count))
+			lines.append('%s_sum%s %s' % (name, formatLabels(labels), repr(total)))
+			lines.append('%s_count%s %s' % (name, formatLabels(labels), count))
+		return '\n'.join(lines) + '\n'
+
+
+class Timer(object):
+	def __init__(self, metrics, name, labels):
+		self.metrics = metrics
+		self.name = name
+		self.labels = labels
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.metrics.observe(self.name, time.time() - self.start, **self.labels)
+		return False
+
+# Totals of each counter and of the time in each histogram, counted for one message.
+class MessageCounts(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		# (name, labels) -> value, histograms as their name with '_sum'.
+		self.totals = {}
+
+	def add(self, key, value):
+		with self.lock:
+			self.totals[key] = self.totals.get(key, 0) + value
+
+	# One line about the message: time per stage, then records, datapoints and requests.
+	def summary(self):
+		with self.lock:
+			totals = dict(self.totals)
+		def total(name, match = None):
+			return sum(value for key, value in totals.items() if key[0] == name and (match == None or match in key[1]))
+
+		stages = sorted(set(dict(labels).get('stage') for name, labels in totals if name == 'extractor_stage_seconds_sum'))
+		times = ', '.join('%s %.2f s' % (stage, total('extractor_stage_seconds_sum', ('stage', stage))) for stage in stages)
+		return '%s; %s rows, %s datapoints, %s failed, %s requests to clowder, %s failed' % (
+			times or 'no stages timed',
+			total('extractor_rows_total'),
+			total('extractor_datapoints_total'),
+			total('extractor_datapoints_failed_total'),
+			total('clowder_requests_total'),
+			total('clowder_request_failures_total'))
+
+# Attaches the MessageCounts to the current thread in the block of a with statement.
+class Collecting(object):
+	def __init__(self, metrics, counts):
+		self.metrics = metrics
+		self.counts = counts
+
+	def __enter__(self):
+		self.previous = self.metrics.collector()
+		self.metrics.attach(self.counts)
+		return self.counts
+
+	def __exit__(self, type, value, traceback):
+		self.metrics.attach(self.previous)
+		return False
+
+def formatLabels(labels):
+	if len(labels) == 0:
+		return ''
+	return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels)
+
+# Shared by every message handled by this process.
+METRICS = Metrics()
+
+# ----------------------------------------------------------------------
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path.split('?')[0] != '/metrics':
+			self.send_error(404)
+			return
+		text = METRICS.render()
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4')
+		self.send_header('Content-Length', str(len(text)))
+		self.end_headers()
+		self.wfile.write(text)
+
+	def log_message(self, format, *args):
+		pass
+
+# Serve METRICS on http://<address>:<port>/metrics from a background thread.
+def start_metrics_server(port, address = ''):
+	server = BaseHTTPServer.HTTPServer((address, port), MetricsHandler)
+	thread = threading.Thread(target=server.serve_forever, name='metrics')
+	thread.daemon = True
+	thread.start()
+	logging.info('Serving metrics on port %s' % server.server_address[1])
+	return server
@@ -1,14 +1,21 @@
 #!/usr/bin/python
 
-import math
+import mmap
+import calendar
 import datetime
 import dateutil.parser
 import dateutil.tz
 import csv
 import json
+import logging
+import itertools
+import numpy as np
 
 DEBUG = True
 
+# Number of records parsed at a time by iter_columns.
+COLUMN_CHUNK_SIZE = 10000
+
 def void():
 	pass
 def log(x):
@@ -27,15 +34,128 @@ def ISOTimeString2TimeStamp(timeStr):
 	isoStartTime = datetime.datetime(1970, 1, 1, 0, 0, 0, 0, ISO_8601_UTC_MEAN)
 	return int((time - isoStartTime).total_seconds())
 
+# Offset of the given timezone from UTC, in seconds.
+def utcOffsetSeconds(tz):
+	offset = tz.utcoffset(None)
+	return 0 if offset == None else int(offset.total_seconds())
+
+# Decoder for the "YYYY-MM-DD HH:MM:SS" logger times found in TOA5 files.
+# Records are written in order, so the epoch of the date part is cached and only the time of day is parsed.
+class TimestampDecoder(object):
+	def __init__(self, utc_offset = ISO_8601_UTC_MEAN):
+		self.offsetSeconds = utcOffsetSeconds(utc_offset)
+		self.tzname = utc_offset.tzname(None)
+		self.date = None
+		self.dateTimestamp = None
+
+	# Convert the given logger time to timestamps in seconds.
+	def timestamp(self, timeStr):
+		if len(timeStr) != 19 or timeStr[10] != ' ' or timeStr[13] != ':' or timeStr[16] != ':':
+			raise ValueError('Unsupported time "%s".' % timeStr)
+		date = timeStr[:10]
+		if date != self.date:
+			self.dateTimestamp = calendar.timegm(datetime.datetime.strptime(date, '%Y-%m-%d').timetuple()) - self.offsetSeconds
+			self.date = date
+		return self.dateTimestamp + int(timeStr[11:13]) * 3600 + int(timeStr[14:16]) * 60 + int(timeStr[17:19])
+
+	# Convert the given logger time to an ISO time string.
+	def isoformat(self, timeStr):
+		return timeStr[:10] + 'T' + timeStr[11:] + self.tzname
+
 def tempUnit2K(value, unit):
-	if unit == 'Deg C':
-		return value + 273.15
-	elif unit == 'Deg F':
-		return (value + 459.67) * 5 / 9
-	elif unit == 'Deg K':
-		return value
+	return unitConverter(unit, 'air_temperature')(value)
+
+def identity(value):
+	return value
+
+# Spell a TOA5 unit the same way however the logger program wrote it, e.g. 'Deg C' and 'degC', or 'W/m^2' and 'W/m2'.
+def normalizeUnit(unit):
+	unit = unit.strip().lower().replace(' ', '')
+	return unit.replace(u'\u00b2', '2').replace('^2', '2').replace(u'\u00b5', 'u').replace(u'\u03bc', 'u')
+
+# Conversions from a TOA5 unit to the unit each CF standard name is reported in, keyed by (normalized unit, standard name).
+# They work on single values as well as on whole NumPy columns.
+UNIT_CONVERSIONS = {}
+
+def registerUnits(standardName, units, convert):
+	for unit in units:
+		UNIT_CONVERSIONS[(normalizeUnit(unit), standardName)] = convert
+
+# Units that are a multiple of the unit of their standard name, keyed as UNIT_CONVERSIONS, so they can be rescaled to one another.
+UNIT_SCALES = {}
+
+def registerScale(standardName, units, scale):
+	registerUnits(standardName, units, identity if scale == 1 else lambda value: value * scale)
+	for unit in units:
+		UNIT_SCALES[(normalizeUnit(unit), standardName)] = scale
+
+# Standard names posted in the unit their streams have always had, the one of the files so far, instead of the unit of the standard name.
+# Converting them would mix units within a stream. A file in another unit is rescaled to the unit of the stream.
+FILE_UNITS = {
+	'relative_humidity': '%',
+	'surface_downwelling_photosynthetic_photon_flux_in_air': 'umol/s/m^2',
+	'wind_speed': 'meters/second',
+	'wind_to_direction': 'degrees',
+	'precipitation_rate': 'mm',
+	'air_pressure': 'kPa'
+}
+
+# Units without a conversion that were warned about, as (unit, standard name).
+UNCONVERTED_UNITS = set()
+
+# Resolve the conversion of the given unit to a standard name once, so it isn't looked up again for every value.
+# Units without a conversion are passed through as they are, with a warning the first time.
+def unitConverter(unit, standardName):
+	if standardName in FILE_UNITS:
+		convert = streamUnitConverter(unit, standardName, FILE_UNITS[standardName])
 	else:
-		raise ValueError('Unsupported unit "%s".' % unit)
+		convert = UNIT_CONVERSIONS.get((normalizeUnit(unit), standardName))
+	if convert == None:
+		if (unit, standardName) not in UNCONVERTED_UNITS:
+			UNCONVERTED_UNITS.add((unit, standardName))
+			logging.warning('No conversion of unit "%s" for %s, values are kept as they are.' % (unit, standardName))
+		return identity
+	return convert
+
+# Conversion of the given unit to the one of the stream, or None if they aren't multiples of the same unit.
+def streamUnitConverter(unit, standardName, streamUnit):
+	if normalizeUnit(unit) == normalizeUnit(streamUnit):
+		return identity
+	scale = UNIT_SCALES.get((normalizeUnit(unit), standardName))
+	streamScale = UNIT_SCALES.get((normalizeUnit(streamUnit), standardName))
+	if scale == None or streamScale == None:
+		return None
+	return lambda value: value * (float(scale) / streamScale)
+
+# K
+registerUnits('air_temperature', ['Deg C', 'C'], lambda value: value + 273.15)
+registerUnits('air_temperature', ['Deg F', 'F'], lambda value: (value + 459.67) * 5 / 9)
+registerUnits('air_temperature', ['Deg K', 'K'], identity)
+# %
+registerScale('relative_humidity', ['%', 'percent'], 1)
+# m/s
+registerScale('wind_speed', ['meters/second', 'm/s', 'm s-1'], 1)
+registerScale('wind_speed', ['mph', 'miles/hour'], 0.44704)
+registerScale('wind_speed', ['km/h', 'kph'], 1 / 3.6)
+registerScale('wind_speed', ['knots', 'kt'], 1852 / 3600.0)
+# Degrees clockwise from north.
+registerScale('wind_to_direction', ['degrees', 'deg', 'Deg'], 1)
+# W/m^2
+registerScale('surface_downwelling_shortwave_flux_in_air', ['W/m^2', 'W/m2', 'W m-2', 'Watts/meter^2'], 1)
+registerScale('surface_downwelling_shortwave_flux_in_air', ['kW/m^2', 'kW m-2'], 1000)
+# umol/m^2/s
+registerScale('surface_downwelling_photosynthetic_photon_flux_in_air', ['umol/s/m^2', 'umol/m^2/s', 'umol m-2 s-1'], 1)
+registerScale('surface_downwelling_photosynthetic_photon_flux_in_air', ['mmol/s/m^2', 'mmol/m^2/s', 'mmol m-2 s-1'], 1000)
+# mm over the record interval
+registerScale('precipitation_rate', ['mm'], 1)
+registerScale('precipitation_rate', ['in', 'inches'], 25.4)
+# Pa
+registerScale('air_pressure', ['Pa'], 1)
+registerScale('air_pressure', ['hPa', 'mbar', 'mb'], 100)
+registerScale('air_pressure', ['kPa'], 1000)
+registerScale('air_pressure', ['inHg'], 3386.389)
+registerScale('air_pressure', ['mmHg'], 133.322)
+
 """
 def relHumidUnit2Percent(value, unit):
 	if unit == '%':
@@ -51,14 +171,18 @@ def speedUnit2MeterPerSecond(value):
 		value
 """
 
+# A missing magnitude gives nan, as every other missing value is.
 def extractXFactor(magnitude, degreeFromNorth):
-	if(math.isnan(magnitude)):
-		return "NaN"
-	return magnitude * math.sin(math.radians(degreeFromNorth));
+	return magnitude * np.sin(np.radians(degreeFromNorth));
 def extractYFactor(magnitude, degreeFromNorth):
-	if(math.isnan(magnitude)):
-		return "NaN"
-	return magnitude * math.cos(math.radians(degreeFromNorth));
+	return magnitude * np.cos(np.radians(degreeFromNorth));
+
+# Quantities derived from others, as (standard names of the inputs, derivation).
+# The inputs are converted to the units of their standard names first.
+DERIVED_QUANTITIES = {
+	'eastward_wind': (['wind_speed', 'wind_to_direction'], extractXFactor),
+	'northward_wind': (['wind_speed', 'wind_to_direction'], extractYFactor)
+}
 
 STATION_GEOMETRY = {
 	'Weather CEN':{
@@ -98,132 +222,404 @@ STATION_GEOMETRY = {
 
 #AirTC_Avg","RH1_Avg","WindSpd_Avg","WindSpd_Max","WindDir_Avg","PAR_APOGE_Avg","RAIN_Tot","PRESSURE_Avg"
 
-# Each mapping function can decide to return one or multiple tuple, so leave the list to them.
+# Each TOA5 column can map to one or multiple properties, as (property, input columns) tuples.
+# A property that is one of the DERIVED_QUANTITIES is derived from its input columns, any other is read from its only input column.
+# The inputs are converted with UNIT_CONVERSIONS from the units in the file header, see HeaderPlan.
 PROP_MAPPING = {
-	'AirTC_Avg': lambda d: [(
-		'air_temperature',
-		tempUnit2K(float(d['value']), d['meta']['unit'])
-	)],
-	'RH1_Avg': lambda d: [(
-		'relative_humidity',
-		float(d['value'])
-	)],
-	'PAR_APOGE_Avg': lambda d: [(
-		'surface_downwelling_photosynthetic_photon_flux_in_air',
-		float(d['value'])
-	)],
-	# If Wind Direction is present, split into speed east and speed north it if we can find Wind Speed.
-	'WindDir_Avg': lambda d: [
-		('eastward_wind', extractXFactor(float(d['record']['WindDir_Avg']), float(d['value']))),
-		('northward_wind', extractYFactor(float(d['record']['WindDir_Avg']), float(d['value'])))
+	'AirTC_Avg': [('air_temperature', ['AirTC_Avg'])],
+	'RH1_Avg': [('relative_humidity', ['RH1_Avg'])],
+	'PAR_APOGE_Avg': [('surface_downwelling_photosynthetic_photon_flux_in_air', ['PAR_APOGE_Avg'])],
+	# If Wind Direction is present, split into speed east and speed north.
+	# The streams have always had the direction itself as the magnitude, it stays that way so they are consistent.
+	'WindDir_Avg': [
+		('eastward_wind', ['WindDir_Avg', 'WindDir_Avg']),
+		('northward_wind', ['WindDir_Avg', 'WindDir_Avg'])
 	],
-	# If Wind Speed is present, process it if we can find Wind Direction.
-	'WindSpd_Avg': lambda d: [(
-		'wind_speed',
-		float(d['value'])
-	)],
-	'RAIN_Tot': lambda d: [(
-		'precipitation_rate',
-		float(d['value'])
-	)],
-	'PRESSURE_Avg': lambda d:[(
-		'air_pressure',
-		float(d['value'])
-	)]	
+	'WindSpd_Avg': [('wind_speed', ['WindSpd_Avg'])],
+	'RAIN_Tot': [('precipitation_rate', ['RAIN_Tot'])],
+	'PRESSURE_Avg': [('air_pressure', ['PRESSURE_Avg'])]
 }
 
+# Compiled plans by header signature, so every file with the same columns and units shares one.
+HEADER_PLANS = {}
+
+# The TOA5 header compiled into the steps that turn a raw row into properties.
+# Only the columns needed by PROP_MAPPING are read, by index, with their unit conversions resolved up front.
+class HeaderPlan(object):
+	def __init__(self, names, props):
+		self.names = names
+		# Indexes of the columns read from each row.
+		self.columns = []
+		# (property, position of the input in the values read, conversion) for properties read from one column.
+		self.single = []
+		# (property, positions of the inputs in the values read, conversions, derivation) for derived ones.
+		self.derived = []
+
+		positions = {}
+		for name in names:
+			if name not in PROP_MAPPING:
+				continue
+			for propName, inputs in PROP_MAPPING[name]:
+				# Records can't be converted without every input, the file fails as it did before the plans.
+				missing = [column for column in inputs if column not in props]
+				if len(missing) > 0:
+					raise ValueError('Column %s needed for %s is missing.' % (', '.join(missing), propName))
+				if propName in DERIVED_QUANTITIES:
+					standardNames, derive = DERIVED_QUANTITIES[propName]
+				else:
+					standardNames, derive = [propName], None
+				converters = [unitConverter(props[column]['unit'], standardName) for column, standardName in zip(inputs, standardNames)]
+				for column in inputs:
+					if column not in positions:
+						positions[column] = len(self.columns)
+						self.columns.append(names.index(column))
+				if derive == None:
+					self.single.append((propName, positions[inputs[0]], converters[0]))
+				else:
+					self.derived.append((propName, [positions[column] for column in inputs], converters, derive))
+
+	# Convert a raw row, as a list of values, into properties.
+	def properties(self, row):
+		return self.convert([float(row[index]) for index in self.columns])
+
+	# Convert whole float64 columns, as given by a ColumnRecord, into property columns.
+	def column_properties(self, record):
+		return self.convert([record[self.names[index]] for index in self.columns])
+
+	def convert(self, values):
+		newProps = dict([(propName, convert(values[position])) for propName, position, convert in self.single])
+		for propName, positions, converters, derive in self.derived:
+			newProps[propName] = derive(*[convert(values[position]) for position, convert in zip(positions, converters)])
+		return newProps
+
+# Get the compiled plan for the given columns and their metadata.
+def header_plan(names, props):
+	signature = tuple((name, props[name]['unit']) for name in names)
+	plan = HEADER_PLANS.get(signature)
+	if plan == None:
+		plan = HeaderPlan(names, props)
+		HEADER_PLANS[signature] = plan
+	return plan
 
 def transformProps(propMetaDict, propValDict):
-	newProps = []
-	for propName in propValDict:
-		if propName in PROP_MAPPING:
-			newProps += PROP_MAPPING[propName]({
-				'meta': propMetaDict[propName],
-				'value': propValDict[propName],
-				'record': propValDict
-			})
-	return dict(newProps)
+	names = [propName for propName in propValDict if propName in propMetaDict]
+	return header_plan(names, propMetaDict).properties([propValDict[propName] for propName in names])
 
 def parse_file_header_line(linestr):
 	return map(lambda x: json.loads(x), str(linestr).split(','))
 
+# Read the 4 TOA5 header lines from the file and describe its columns.
+# The file position is left at the first data row.
+def parse_file_header(csvfile):
+	# First line is always the header.
+	# @see {@link https://www.manualslib.com/manual/538296/Campbell-Cr9000.html?page=41#manual}
+	header_lines = [
+		csvfile.readline()
+	]
+
+	file_format, station_name, logger_model, logger_serial, os_version, dld_file, dld_sig, table_name = parse_file_header_line(header_lines[0])
+
+	if file_format != 'TOA5':
+		raise ValueError('Unsupported format "%s".' % file_format)
+
+	# For TOA5, there are in total 4 header lines.
+	# @see {@link https://www.manualslib.com/manual/538296/Campbell-Cr9000.html?page=43#manual}
+	while (len(header_lines) < 4):
+		header_lines.append(csvfile.readline())
+
+	prop_names = parse_file_header_line(header_lines[1])
+	prop_units = parse_file_header_line(header_lines[2])
+	prop_sample_method = parse_file_header_line(header_lines[3])
+
+	# Associate the above lists.
+	props = dict()
+	for x in xrange(len(prop_names)):
+		props[prop_names[x]] = {
+			'title': prop_names[x],
+			'unit': prop_units[x],
+			'sample_method': prop_sample_method[x]
+		}
+	# [DEBUG] Print the property details if needed.
+	#print json.dumps(props)
+
+	return {
+		'station_name': station_name,
+		'table_name': table_name,
+		'names': prop_names,
+		'units': prop_units,
+		'sample_methods': prop_sample_method,
+		'props': props
+	}
+
+# Byte offset of the first data row after previousTime in seconds, found through a TOA5Map.
+# This returns the offset, and the number of rows before it (None if unknown).
+def resume_offset(filepath, previousTime, checkpoint = None, utc_offset = ISO_8601_UTC_MEAN):
+	toa5 = TOA5Map(filepath, utc_offset)
+	try:
+		return toa5.resume(previousTime, checkpoint)
+	finally:
+		toa5.close()
+
 # ----------------------------------------------------------------------
-# Parse the CSV file and return a list of dictionaries.
-def parse_file(filepath, last_processed_time ,utc_offset = ISO_8601_UTC_MEAN):
-	results = []
+# Parse the CSV file and yield the dictionary of each record as it is read.
+def iter_records(filepath, last_processed_time, utc_offset = ISO_8601_UTC_MEAN, checkpoint = None):
 	with open(filepath) as csvfile:
-		# First line is always the header.
-		# @see {@link https://www.manualslib.com/manual/538296/Campbell-Cr9000.html?page=41#manual}
-		header_lines = [
-			csvfile.readline()
-		]
-
-		file_format, station_name, logger_model, logger_serial, os_version, dld_file, dld_sig, table_name = parse_file_header_line(header_lines[0])
-
-		if file_format != 'TOA5':
-			raise ValueError('Unsupported format "%s".' % file_format)
-
-		# For TOA5, there are in total 4 header lines.
-		# @see {@link https://www.manualslib.com/manual/538296/Campbell-Cr9000.html?page=43#manual}
-		while (len(header_lines) < 4):
-			header_lines.append(csvfile.readline())
-
-		prop_names = parse_file_header_line(header_lines[1])
-		prop_units = parse_file_header_line(header_lines[2])
-		prop_sample_method = parse_file_header_line(header_lines[3])
-
-		# Associate the above lists.
-		props = dict()
-		for x in xrange(len(prop_names)):
-			props[prop_names[x]] = {
-				'title': prop_names[x],
-				'unit': prop_units[x],
-				'sample_method': prop_sample_method[x]
-			}
-		# [DEBUG] Print the property details if needed.
-		#print json.dumps(props)
-	
+		header = parse_file_header(csvfile)
+		station_name = header['station_name']
+		props = header['props']
+		prop_names = header['names']
+
+		decoder = TimestampDecoder(utc_offset)
+
 		# move ahead to the last processed time if the file had been processed earlier
 		if(last_processed_time!=0):
-			timestamp = "0"
-			last_time = dateutil.parser.parse(last_processed_time).strftime('%Y-%m-%d %H:%M:%S')
-			while(timestamp!=last_time):
-				line = csvfile.readline().split(',')
-				timestamp = line[0][1:-1]
+			epochPrev = ISOTimeString2TimeStamp(last_processed_time)
+			csvfile.seek(resume_offset(filepath, epochPrev, checkpoint, utc_offset)[0])
 			timestampPrev = last_processed_time
 		else:
 			pos = csvfile.tell()
 			row = json.loads(csvfile.readline().split(',')[0])
 			csvfile.seek(pos)
 			timestampPrev = (datetime.datetime.strptime(row, '%Y-%m-%d %H:%M:%S')-datetime.timedelta(minutes=15)).isoformat()+ utc_offset.tzname(None)
+			epochPrev = decoder.timestamp(row) - 15 * 60
 			
 			
-		reader = csv.DictReader(csvfile, fieldnames=prop_names)
+		plan = header_plan(prop_names, props)
+		timeIndex = prop_names.index('TIMESTAMP')
+		reader = csv.reader(csvfile)
  
 		
 		for row in reader:
-			timestamp = datetime.datetime.strptime(row['TIMESTAMP'], '%Y-%m-%d %H:%M:%S').isoformat() + utc_offset.tzname(None) 		
+			if len(row) == 0:
+				continue
+			timestamp = decoder.isoformat(row[timeIndex])
+			epoch = decoder.timestamp(row[timeIndex])
 
 			newResult = {
 				# @type {string}
 				'start_time': timestampPrev,
 				# @type {string}
 				'end_time': timestamp,
-				'properties': transformProps(props, row),
+				# @type {int}
+				'start_timestamp': epochPrev,
+				# @type {int}
+				'end_timestamp': epoch,
+				'properties': plan.properties(row),
 				# @type {string}
 				'type': 'Feature',
 				'geometry': STATION_GEOMETRY[station_name]
 			}
 			timestampPrev = timestamp
+			epochPrev = epoch
 			# Enable this if the raw data needs to be kept.
 # 			newResult['properties']['_raw'] = {
 # 				'data': row,
 # 				'units': prop_units,
 # 				'sample_method': prop_sample_method
 # 			}
-			results.append(newResult)
+			yield newResult
+
+# Parse the CSV file and return a list of dictionaries.
+def parse_file(filepath, last_processed_time ,utc_offset = ISO_8601_UTC_MEAN, checkpoint = None):
+	return list(iter_records(filepath, last_processed_time, utc_offset, checkpoint))
+
+# Raw text columns of a TOA5 file, converted to float64 arrays on first access.
+# Rows before firstRow are left out.
+class ColumnRecord(dict):
+	def __init__(self, names, rawColumns, firstRow = 0):
+		dict.__init__(self)
+		self.names = names
+		self.rawColumns = rawColumns
+		self.firstRow = firstRow
+
+	def __missing__(self, name):
+		column = np.array(self.rawColumns[self.names.index(name)][self.firstRow:], dtype=np.float64)
+		self[name] = column
+		return column
+
+# Convert a column of "YYYY-MM-DD HH:MM:SS" logger times to epoch seconds.
+def parse_timestamp_column(values, utc_offset):
+	return np.array(values, dtype='datetime64[s]').astype(np.int64) - utcOffsetSeconds(utc_offset)
+
+# ----------------------------------------------------------------------
+# Parse the CSV file into columns, skipping records up to last_processed_time.
+# This returns a dictionary with int64 arrays of epoch seconds in 'start_timestamp' and 'timestamp'
+# and a float64 array for each mapped property in 'properties'.
+def parse_file_columns(filepath, last_processed_time, utc_offset = ISO_8601_UTC_MEAN):
+	with open(filepath) as csvfile:
+		header = parse_file_header(csvfile)
+		rows = list(csv.reader(csvfile))
+	previousTime = None if last_processed_time == 0 else ISOTimeString2TimeStamp(last_processed_time)
+	return parse_rows_columns(header, rows, previousTime, utc_offset)
+
+# Parse the CSV file and yield columns of at most chunkSize records at a time, skipping records up to last_processed_time.
+# Memory use is bounded by the chunk size rather than by the size of the file.
+# Each chunk has a 'checkpoint' with the byte 'offset' just past its last row and the number of 'rows' up to there,
+# which can be given back with its last time to resume without reading the file from the top.
+def iter_columns(filepath, last_processed_time, utc_offset = ISO_8601_UTC_MEAN, chunkSize = COLUMN_CHUNK_SIZE, checkpoint = None):
+	previousTime = None if last_processed_time == 0 else ISOTimeString2TimeStamp(last_processed_time)
+	with open(filepath) as csvfile:
+		header = parse_file_header(csvfile)
+		position = {
+			'offset': csvfile.tell(),
+			'rows': 0
+		}
+		if previousTime != None:
+			position['offset'], position['rows'] = resume_offset(filepath, previousTime, checkpoint, utc_offset)
+			csvfile.seek(position['offset'])
+
+		# TOA5 rows are single lines, so the position of each row is counted as it is read.
+		def lines():
+			for line in csvfile:
+				position['offset'] += len(line)
+				if position['rows'] != None:
+					position['rows'] += 1
+				yield line
+
+		reader = csv.reader(lines())
+		while True:
+			rows = list(itertools.islice(reader, chunkSize))
+			if len(rows) == 0:
+				break
+			columns = parse_rows_columns(header, rows, previousTime, utc_offset)
+			if len(columns['timestamp']) > 0:
+				previousTime = int(columns['timestamp'][-1])
+				columns['checkpoint'] = dict(position)
+				yield columns
+
+# Turn the raw rows of a TOA5 file into columns.
+# previousTime is the end of the record before these rows in seconds, or None at the start of the file.
+def parse_rows_columns(header, rows, previousTime, utc_offset):
+	rawColumns = zip(*rows) if len(rows) > 0 else [()] * len(header['names'])
+	return parse_raw_columns(header, rawColumns, previousTime, utc_offset)
+
+# Turn the raw text columns of a TOA5 file into parsed columns.
+def parse_raw_columns(header, rawColumns, previousTime, utc_offset):
+	prop_names = header['names']
+	timestamps = parse_timestamp_column(rawColumns[prop_names.index('TIMESTAMP')], utc_offset)
+	firstRow = 0
+
+	# Each record starts where the previous one ended.
+	# The first one in the file starts one 15 minute interval before itself.
+	# Rows are sorted, so the ones up to previousTime are all at the top.
+	if previousTime != None:
+		firstStartTime = previousTime
+		firstRow = int(np.searchsorted(timestamps, previousTime, 'right'))
+		timestamps = timestamps[firstRow:]
+	elif len(timestamps) > 0:
+		firstStartTime = timestamps[0] - 15 * 60
+	else:
+		firstStartTime = 0
+	startTimestamps = np.empty_like(timestamps)
+	startTimestamps[:1] = firstStartTime
+	startTimestamps[1:] = timestamps[:-1]
+
+	record = ColumnRecord(prop_names, rawColumns, firstRow)
+
+	return {
+		'station_name': header['station_name'],
+		'start_timestamp': startTimestamps,
+		'timestamp': timestamps,
+		'properties': header_plan(prop_names, header['props']).column_properties(record)
+	}
+
+# Present parsed columns as the list of record dictionaries returned by parse_file.
+def columns_to_records(columns, utc_offset = ISO_8601_UTC_MEAN):
+	offset = utc_offset.utcoffset(None)
+	tzname = utc_offset.tzname(None)
+	geometry = STATION_GEOMETRY[columns['station_name']]
+	properties = [(key, column.tolist()) for key, column in columns['properties'].items()]
+
+	def isoformat(value):
+		return (datetime.datetime.utcfromtimestamp(value) + offset).isoformat() + tzname
+
+	results = []
+	startTimes = columns['start_timestamp'].tolist()
+	for index, value in enumerate(columns['timestamp'].tolist()):
+		results.append({
+			'start_time': isoformat(startTimes[index]),
+			'end_time': isoformat(value),
+			'start_timestamp': startTimes[index],
+			'end_timestamp': value,
+			'properties': dict((key, column[index]) for key, column in properties),
+			'type': 'Feature',
+			'geometry': geometry
+		})
 	return results
 
+# ----------------------------------------------------------------------
+# Read-only view of a TOA5 file through mmap.
+# Data rows are found by bisecting on TIMESTAMP over the mapped buffer, so finding where to resume
+# only touches the pages of the rows it looks at.
+# Note: rows have to be sorted by time.
+class TOA5Map(object):
+	def __init__(self, filepath, utc_offset = ISO_8601_UTC_MEAN):
+		self.file = open(filepath, 'rb')
+		try:
+			self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		except:
+			self.file.close()
+			raise
+		self.header = parse_file_header(self.buffer)
+		self.dataStart = self.buffer.tell()
+		self.size = self.buffer.size()
+		self.decoder = TimestampDecoder(utc_offset)
+
+	def close(self):
+		self.buffer.close()
+		self.file.close()
+
+	# Start of the first row beginning at or after the given byte offset.
+	def row_start(self, position):
+		if position <= self.dataStart:
+			return self.dataStart
+		lineEnd = self.buffer.find('\n', position - 1)
+		return self.size if lineEnd == -1 else lineEnd + 1
+
+	# Start of the row before the one beginning at the given byte offset, or None if there isn't one.
+	def previous_row_start(self, position):
+		if position <= self.dataStart:
+			return None
+		return max(self.buffer.rfind('\n', self.dataStart, position - 1) + 1, self.dataStart)
+
+	# Time of the row beginning at the given byte offset in seconds, or None past the last row or on an empty line.
+	def row_time(self, position):
+		fieldEnd = self.buffer.find(',', position, min(position + 64, self.size))
+		if fieldEnd == -1 or '\n' in self.buffer[position:fieldEnd]:
+			return None
+		return self.decoder.timestamp(self.buffer[position:fieldEnd].strip('"'))
+
+	# Start of the first row at or after the given time in seconds.
+	def bisect(self, timestamp):
+		low = self.dataStart
+		high = self.size
+		while low < high:
+			middle = (low + high) // 2
+			rowTime = self.row_time(self.row_start(middle))
+			if rowTime == None or rowTime >= timestamp:
+				high = middle
+			else:
+				low = middle + 1
+		return self.row_start(low)
+
+	# Start of the first row after previousTime in seconds, and the number of rows before it (None if unknown).
+	# The checkpoint saved by the previous run is tried first: its 'offset' is where the rows after previousTime begin,
+	# and is only used if the row ending there is at previousTime. Otherwise the rows are bisected by time.
+	def resume(self, previousTime, checkpoint = None):
+		if checkpoint != None and checkpoint.get('offset') != None and self.dataStart < checkpoint['offset'] <= self.size:
+			offset = checkpoint['offset']
+			if self.buffer[offset - 1] == '\n':
+				try:
+					matched = self.row_time(self.previous_row_start(offset)) == previousTime
+				except ValueError:
+					matched = False
+				if matched:
+					return offset, checkpoint.get('rows')
+			debug_log('Checkpoint does not match, searching for the last processed time...')
+
+		# Times are whole seconds.
+		return self.bisect(previousTime + 1), None
+
 if __name__ == "__main__":
 	size = 5 * 60
 	tz = dateutil.tz.tzoffset("-07:00", -7 * 60 * 60)
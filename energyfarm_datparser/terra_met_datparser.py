@@ -13,12 +13,42 @@ import pyclowder.files
 import pyclowder.datasets
 
 from parser import *
+from uploader import *
+from ledger import *
+from outbox import *
+from idcache import *
+from metrics import *
+from profiling import *
 
 
 class MetDATFileParser(Extractor):
 	def __init__(self):
 		Extractor.__init__(self)
 
+		self.parser.add_argument('--upload-batch', dest="upload_batch", type=int, nargs='?',
+								 default=(BULK_BATCH_SIZE),
+								 help="datapoints posted to geostreams per bulk request (default is %s)" % BULK_BATCH_SIZE)
+		self.parser.add_argument('--upload-workers', dest="upload_workers", type=int, nargs='?',
+								 default=(UPLOAD_WORKERS),
+								 help="threads posting datapoints to geostreams (default is %s)" % UPLOAD_WORKERS)
+		self.parser.add_argument('--upload-ledger', dest="upload_ledger", type=str, nargs='?',
+								 default=(''),
+								 help="SQLite file recording the datapoints created, so they are skipped when a message is processed again (default is empty, no ledger)")
+		self.parser.add_argument('--outbox', dest="outbox", type=str, nargs='?',
+								 default=(''),
+								 help="SQLite file datapoints are written to before a background thread posts them, so they survive restarts and geostreams outages (default is empty, datapoints are posted while the message is processed)")
+		self.parser.add_argument('--max-requests', dest="max_requests", type=int, nargs='?',
+								 default=(0),
+								 help="requests to clowder in flight at once across every message handled at the same time, as with --num (default is 0, no limit)")
+		self.parser.add_argument('--metrics-port', dest="metrics_port", type=int, nargs='?',
+								 default=(0),
+								 help="port serving metrics in the Prometheus text format on /metrics (default is 0, not served)")
+		self.parser.add_argument('--profile', dest="profile", action='store_true',
+								 help="profile every message with cProfile and memory snapshots, messages can also ask for it with the parameter \"profile\": true")
+		self.parser.add_argument('--profile-dir', dest="profile_dir", type=str, nargs='?',
+								 default=(PROFILE_DIR),
+								 help="directory the profiles of each resource are written under (default is %s)" % PROFILE_DIR)
+
 		# parse command line and load default logging configuration
 		self.setup()
 
@@ -26,6 +56,21 @@ class MetDATFileParser(Extractor):
 		logging.getLogger('pyclowder').setLevel(logging.DEBUG)
 		logging.getLogger('__main__').setLevel(logging.DEBUG)
 
+		# assign other arguments
+		self.upload_batch = self.args.upload_batch
+		self.upload_workers = self.args.upload_workers
+		self.upload_ledger = UploadLedger(self.args.upload_ledger) if self.args.upload_ledger else None
+		self.outbox = Outbox(self.args.outbox) if self.args.outbox else None
+
+		self.profile = self.args.profile
+		self.profile_dir = self.args.profile_dir
+
+		limit_requests(self.args.max_requests)
+		if self.outbox != None:
+			OutboxDrainer(self.outbox, self.upload_batch, ledger=self.upload_ledger).start()
+		if self.args.metrics_port:
+			start_metrics_server(self.args.metrics_port)
+
 
 	def check_message(self, connector, host, secret_key, resource, parameters):
 		# Not completed yet #
@@ -33,6 +78,22 @@ class MetDATFileParser(Extractor):
 		return CheckMessage.download
 
 	def process_message(self, connector, host, secret_key, resource, parameters):
+		# Count the message, and log what it and the threads uploading for it took.
+		with METRICS.collect() as counts:
+			status = 'failed'
+			try:
+				# Profiling costs nothing unless it is asked for.
+				if self.profile or profile_requested(parameters):
+					with MessageProfile(os.path.join(self.profile_dir, resource['id'])):
+						self.process_file(connector, host, secret_key, resource, parameters)
+				else:
+					self.process_file(connector, host, secret_key, resource, parameters)
+				status = 'completed'
+			finally:
+				METRICS.inc('extractor_messages_total', status=status)
+				logging.info('%s: %s' % (resource['id'], counts.summary()))
+
+	def process_file(self, connector, host, secret_key, resource, parameters):
 		ISO_8601_UTC_OFFSET = dateutil.tz.tzoffset("-07:00", -7 * 60 * 60)
 	
 		# Get input files
@@ -58,50 +119,102 @@ class MetDATFileParser(Extractor):
 			stream_name+= 'SE'
 			main_coords = [40.056910,-88.193573,0]
 
-		# SENSOR is Full Field by default
-		sensor_id = get_sensor_id(host, secret_key, sensor_name)
-		if not sensor_id:
-			sensor_id = create_sensor(host, secret_key, sensor_name, {
+		with METRICS.timer('extractor_stage_seconds', stage='streams'):
+			# Sensor and stream IDs are cached for the whole process, fill the cache the first time a host is seen.
+			ID_CACHE.warm(host, lambda: list_geostreams_ids(host, secret_key))
+
+			# SENSOR is Full Field by default
+			sensor_id = get_or_create_sensor(host, secret_key, sensor_name, {
 				"type": "Point",
 				# These are a point off to the right of the field
 				"coordinates": main_coords
-			})		
-		
+			})
+			
 
-		# Look for stream.
-		
-		stream_id = get_stream_id(host, secret_key, stream_name)
-		if not stream_id:
-			stream_id = create_stream(host, secret_key, sensor_id, stream_name, {
+			# Look for stream.
+			
+			stream_id = get_or_create_stream(host, secret_key, sensor_id, stream_name, {
 				"type": "Point",
 				"coordinates": [0,0,0]
 			})
 		
-		# Get metadata to check till what time the file was processed last. Start processing the file after this time
-		md = pyclowder.files.download_metadata(connector, host, secret_key, resource['id'], self.extractor_info['name'])
-		if md != [] and 'content' in md[0] and 'last processed time' in md[0]['content']:
-			last_processed_time = md[0]['content']['last processed time']
-			delete_metadata(connector, host, secret_key, resource['id'], self.extractor_info['name'])
+		with METRICS.timer('extractor_stage_seconds', stage='metadata'):
+			# Get metadata to check till what time the file was processed last. Start processing the file after this time
+			md = pyclowder.files.download_metadata(connector, host, secret_key, resource['id'], self.extractor_info['name'])
+			# The checkpoint holds where in the file that time was, so reading can start there.
+			checkpoint = None
+			if md != [] and 'content' in md[0] and 'last processed time' in md[0]['content']:
+				last_processed_time = md[0]['content']['last processed time']
+				checkpoint = {
+					'offset': md[0]['content'].get('last processed offset'),
+					'rows': md[0]['content'].get('last processed rows')
+				}
+				delete_metadata(connector, host, secret_key, resource['id'], self.extractor_info['name'])
+			else:
+				last_processed_time = 0				
+
+
+		# Datapoints are uploaded in the background while the file is parsed.
+		# With an outbox, they are only written to it and the drainer posts them.
+		if self.outbox != None:
+			uploads = OutboxUploads(self.outbox, host, secret_key)
 		else:
-			last_processed_time = 0				
-
-
-		# Parse file and get all the records in it.
-		records = parse_file(inputfile, last_processed_time,utc_offset=ISO_8601_UTC_OFFSET)
-		# Add props to each record.
-		for record in records:
-			record['properties']['source_file'] = fileId
-			record['stream_id'] = str(stream_id)
-		
-		upload_datapoints(host, secret_key, records)
-
-		last_processed_time = records[-1]["end_time"]
+			uploads = UploadPool(host, secret_key, self.upload_workers, self.upload_batch, ledger=self.upload_ledger)
+
+		# Parse the file a chunk of records at a time, so memory stays bounded no matter how long its history is.
+		# Parse time is the time spent waiting for the next chunk.
+		# If anything fails, the batches still queued are dropped and the upload threads stopped.
+		try:
+			chunks = METRICS.timed(iter_columns(inputfile, last_processed_time, utc_offset=ISO_8601_UTC_OFFSET, checkpoint=checkpoint), 'extractor_stage_seconds', stage='parse')
+			for columns in chunks:
+				with METRICS.timer('extractor_stage_seconds', stage='transform'):
+					records = columns_to_records(columns, ISO_8601_UTC_OFFSET)
+					# Add props to each record.
+					# The epoch times are only for parsing, they aren't posted.
+					for record in records:
+						del record['start_timestamp']
+						del record['end_timestamp']
+						record['properties']['source_file'] = fileId
+						record['stream_id'] = str(stream_id)
+				METRICS.inc('extractor_rows_total', len(records))
+				METRICS.inc('extractor_datapoints_total', len(records))
+
+				# This waits while the upload queue is full.
+				with METRICS.timer('extractor_stage_seconds', stage='upload'):
+					uploads.submit(records)
+
+				last_processed_time = records[-1]["end_time"]
+				checkpoint = columns['checkpoint']
+		except:
+			uploads.abort()
+			raise
+
+		with METRICS.timer('extractor_stage_seconds', stage='upload'):
+			uploaded = uploads.close()
+		METRICS.inc('extractor_datapoints_failed_total', uploaded['failed'])
+		METRICS.inc('extractor_datapoints_refused_total', uploaded['refused'])
+		METRICS.inc('extractor_datapoints_skipped_total', uploaded['skipped'])
+		logging.info('%s: %s datapoints created in %s batches, %s created before, %s queued in the outbox, %s failed, %s of them refused' % (resource['id'], uploaded['succeeded'], uploaded['batches'], uploaded['skipped'], uploaded['queued'], uploaded['failed'], uploaded['refused']))
+
+		# The stream may have gone away, look its ID up again next time.
+		if uploaded['failed'] > 0:
+			ID_CACHE.invalidate('stream', host, stream_name)
+		# Datapoints the server refused would be refused again, they are dropped rather than hold the file back.
+		if uploaded['refused'] > 0:
+			logging.error('%s: %s datapoints refused by the server are not tried again' % (resource['id'], uploaded['refused']))
+		# Resume next time from the earliest datapoint that failed for another reason, so none of them are lost.
+		if len(uploaded['failed_records']) > 0:
+			firstFailed = min(uploaded['failed_records'], key=lambda record: ISOTimeString2TimeStamp(record['start_time']))
+			last_processed_time = firstFailed['start_time']
+			checkpoint = None
 
 		metadata = {
 			"@context": ["https://clowder.ncsa.illinois.edu/contexts/metadata.jsonld"],
 			"dataset_id": resource['id'],
 			"content": {"status": "COMPLETED",
-				    "last processed time": last_processed_time					
+				    "last processed time": last_processed_time,
+				    "last processed offset": None if checkpoint == None else checkpoint['offset'],
+				    "last processed rows": None if checkpoint == None else checkpoint['rows']
 				},
 			"agent": {
 				"@type": "extractor",
@@ -110,17 +223,43 @@ class MetDATFileParser(Extractor):
 		}
 
 		# logger.debug(metadata)
-		pyclowder.files.upload_metadata(connector, host, secret_key, resource['id'], metadata)
+		with METRICS.timer('extractor_stage_seconds', stage='metadata'):
+			pyclowder.files.upload_metadata(connector, host, secret_key, resource['id'], metadata)
+
+
+# List the IDs of all sensors and streams on the host as (kind, name, id) tuples.
+def list_geostreams_ids(host, key):
+	if(not host.endswith("/")):
+		host = host+"/"
 
+	ids = []
+	for kind in ['sensor', 'stream']:
+		url = "%sapi/geostreams/%ss?key=%s" % (host, kind, key)
+		r = clowder_request('get', kind + 's', url)
+		r.raise_for_status()
+		for s in r.json():
+			if 'name' in s and 'id' in s:
+				ids.append((kind, s['name'], s['id']))
+	logging.debug("...found %s sensors and streams" % len(ids))
+	return ids
 
 # Get sensor ID from Clowder based on plot name
+# The ID is taken from the process-wide cache when possible.
 def get_sensor_id(host, key, name):
+	return ID_CACHE.get('sensor', host, name, lambda: lookup_sensor_id(host, key, name))
+
+# Get sensor ID from Clowder, creating the sensor if there is none.
+# Messages missing the cache at the same time wait for one lookup and creation, so the sensor is only made once.
+def get_or_create_sensor(host, key, name, geom):
+	return ID_CACHE.get('sensor', host, name, lambda: lookup_sensor_id(host, key, name), lambda: create_sensor(host, key, name, geom))
+
+def lookup_sensor_id(host, key, name):
 	if(not host.endswith("/")):
 		host = host+"/"
 
 	url = "%sapi/geostreams/sensors?sensor_name=%s&key=%s" % (host, name, key)
 	logging.debug("...searching for sensor : "+name)
-	r = requests.get(url)
+	r = clowder_request('get', 'sensors', url)
 	if r.status_code == 200:
 		json_data = r.json()
 		for s in json_data:
@@ -153,10 +292,11 @@ def create_sensor(host, key, name, geom):
 
 	url = "%sapi/geostreams/sensors?key=%s" % (host, key)
 	logging.info("...creating new sensor: "+name)
-	r = requests.post(url,
+	r = clowder_request('post', 'sensors', url,
 					  data=json.dumps(body),
 					  headers={'Content-type': 'application/json'})
 	if r.status_code == 200:
+		ID_CACHE.put('sensor', host, name, r.json()['id'])
 		return r.json()['id']
 	else:
 		logging.error("error creating sensor")
@@ -164,18 +304,6 @@ def create_sensor(host, key, name, geom):
 	return None
 
 
-# Save records as JSON back to GeoStream.
-def upload_datapoints(host, key, records):
-	url = urlparse.urljoin(host, 'api/geostreams/datapoints?key=%s' % key)
-	
-	for record in records:
-		headers = {'Content-type': 'application/json'}
-		r = requests.post(url, data=json.dumps(record), headers=headers)
-		if (r.status_code != 200):
-			logging.error('Problem creating datapoint : [%s] - %s' % (str(r.status_code), r.text))
-	return
-
-
 def delete_metadata(connector, host, key, fileid, extractor=None):
     """Delete file JSON-LD metadata from Clowder.
     Keyword arguments:
@@ -188,19 +316,28 @@ def delete_metadata(connector, host, key, fileid, extractor=None):
     filterstring = "" if extractor is None else "&extractor=%s" % extractor
     url = '%sapi/files/%s/metadata.jsonld?key=%s%s' % (host, fileid, key, filterstring)
     # fetch data
-    result = requests.delete(url, stream=True,
+    result = clowder_request('delete', 'files/metadata', url, stream=True,
                           verify=connector.ssl_verify)
     result.raise_for_status()
     return result.json()
 
 # Get stream ID from Clowder based on stream name
+# The ID is taken from the process-wide cache when possible.
 def get_stream_id(host, key, name):
+	return ID_CACHE.get('stream', host, name, lambda: lookup_stream_id(host, key, name))
+
+# Get stream ID from Clowder, creating the stream if there is none.
+# Messages missing the cache at the same time wait for one lookup and creation, so the stream is only made once.
+def get_or_create_stream(host, key, sensor_id, name, geom):
+	return ID_CACHE.get('stream', host, name, lambda: lookup_stream_id(host, key, name), lambda: create_stream(host, key, sensor_id, name, geom))
+
+def lookup_stream_id(host, key, name):
 	if(not host.endswith("/")):
 		host = host+"/"
 
 	url = urlparse.urljoin(host, 'api/geostreams/streams?stream_name=%s&key=%s' % (name, key))
 	logging.debug("...searching for stream : "+name)
-	r = requests.get(url)
+	r = clowder_request('get', 'streams', url)
 	if r.status_code == 200:
 		json_data = r.json()
 		for s in json_data:
@@ -225,10 +362,11 @@ def create_stream(host, key, sensor_id, name, geom):
 	url = urlparse.urljoin(host, 'api/geostreams/streams?key=%s' % key)
 
 	logging.info("...creating new stream: "+name)
-	r = requests.post(url,
+	r = clowder_request('post', 'streams', url,
 					  data=json.dumps(body),
 					  headers={'Content-type': 'application/json'})
 	if r.status_code == 200:
+		ID_CACHE.put('stream', host, name, r.json()['id'])
 		return r.json()['id']
 	else:
 		logging.error("error creating stream")
@@ -0,0 +1,315 @@
+"""
+uploader.py
+
+Uploads datapoints to the Clowder Geostreams API in bulk batches.
+Batches are retried with backoff on transient errors, and UploadPool
+uploads them from several threads behind a bounded queue. With an
+UploadLedger, datapoints created before are skipped.
+"""
+
+import collections
+import json
+import logging
+import random
+import threading
+import time
+import urlparse
+import Queue
+
+import requests
+
+from metrics import METRICS
+
+# Number of datapoints sent in one bulk request.
+BULK_BATCH_SIZE = 100
+
+# Responses to a bulk request that mean the server doesn't support it.
+BULK_UNSUPPORTED_STATUS = (404, 405, 501)
+
+# Pooled HTTP session shared by every upload, so connections are kept alive.
+SESSION = requests.Session()
+
+# Hosts that rejected bulk requests. Datapoints are posted one at a time to them.
+BULK_UNSUPPORTED_HOSTS = set()
+
+# Attempts at a batch after the first one, when it fails with a server or connection error.
+UPLOAD_RETRIES = 5
+
+# Seconds to wait before the first retry. The wait doubles on each attempt, with random jitter.
+UPLOAD_BACKOFF = 0.5
+
+# Threads uploading batches in an UploadPool.
+UPLOAD_WORKERS = 4
+
+# Batches waiting in an UploadPool before submit() blocks.
+UPLOAD_QUEUE_SIZE = 16
+
+# Requests to Clowder in flight at once from this process, across every message. None is no limit, see limit_requests.
+REQUEST_SLOTS = None
+
+# Server or connection errors worth trying again. A status of None means no response.
+def isTransientError(status):
+	return status == None or status == 429 or status >= 500
+
+
+class DatapointUploader(object):
+	def __init__(self, host, key, batchSize = BULK_BATCH_SIZE, session = SESSION, retries = UPLOAD_RETRIES, backoff = UPLOAD_BACKOFF, ledger = None):
+		if(not host.endswith("/")):
+			host = host+"/"
+
+		self.host = host
+		self.key = key
+		self.batchSize = max(int(batchSize), 1)
+		self.session = session
+		self.retries = retries
+		self.backoff = backoff
+		self.ledger = ledger
+		self.bulkUrl = urlparse.urljoin(host, 'api/geostreams/datapoints/bulk?key=%s' % key)
+		self.url = urlparse.urljoin(host, 'api/geostreams/datapoints?key=%s' % key)
+
+	# Upload the records in batches and return the total counts of the upload.
+	# Datapoints that could not be created are listed in 'failed_records' of the result, apart from the ones
+	# the server refused, which are in 'refused_records' as trying them again would not help.
+	def upload(self, records):
+		summary = newSummary()
+		for batch in self.batches(records):
+			addSummary(summary, self.send(batch))
+		return summary
+
+	def batches(self, records):
+		batch = []
+		for record in records:
+			if len(batch) >= self.batchSize or (len(batch) > 0 and batch[0].get('stream_id') != record.get('stream_id')):
+				yield batch
+				batch = []
+			batch.append(record)
+		if len(batch) > 0:
+			yield batch
+
+	# Upload one batch, retrying what fails with transient errors, and return its counts.
+	def send(self, batch):
+		summary = newSummary()
+		summary['batches'] = 1
+		pending = batch
+		if self.ledger != None:
+			created, pending = self.ledger.partition(batch)
+			summary['skipped'] = len(created)
+			if len(pending) == 0:
+				logging.debug('Batch of stream %s: %s datapoints created before' % (batch[0].get('stream_id'), summary['skipped']))
+				return summary
+		attempt = 0
+		while True:
+			succeeded, rejected, retry = self.upload_batch(pending)
+			summary['succeeded'] += len(succeeded)
+			if self.ledger != None:
+				self.ledger.add(succeeded)
+			summary['refused_records'] += rejected
+			if len(retry) == 0 or attempt >= self.retries:
+				summary['failed_records'] += retry
+				break
+			delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+			logging.warning('Retrying %s datapoints of stream %s in %.1f seconds' % (len(retry), retry[0].get('stream_id'), delay))
+			time.sleep(delay)
+			summary['retries'] += 1
+			attempt += 1
+			pending = retry
+
+		summary['refused'] = len(summary['refused_records'])
+		summary['failed'] = len(summary['failed_records']) + summary['refused']
+		if summary['failed'] > 0:
+			logging.error('Batch of stream %s: %s datapoints created, %s failed' % (batch[0].get('stream_id'), summary['succeeded'], summary['failed']))
+		else:
+			logging.debug('Batch of stream %s: %s datapoints created' % (batch[0].get('stream_id'), summary['succeeded']))
+		return summary
+
+	# Make one attempt at uploading a batch.
+	# This returns the datapoints created, the ones the server refused, and the ones to try again.
+	def upload_batch(self, batch):
+		if self.host not in BULK_UNSUPPORTED_HOSTS:
+			body = {
+				'datapoints': batch,
+				'stream_id': str(batch[0].get('stream_id'))
+			}
+			status, text = self.post(self.bulkUrl, body, 'datapoints/bulk')
+
+			if status == 200:
+				return batch, [], []
+			elif status in BULK_UNSUPPORTED_STATUS:
+				logging.warning('Bulk datapoint upload rejected by %s [%s], posting datapoints one at a time' % (self.host, status))
+				BULK_UNSUPPORTED_HOSTS.add(self.host)
+			elif isTransientError(status):
+				logging.error('Problem creating datapoints : [%s] - %s' % (str(status), text))
+				return [], [], batch
+			else:
+				# The server refused some of the datapoints, find out which ones.
+				logging.warning('Bulk datapoint upload refused [%s] - %s, posting the batch one at a time' % (str(status), text))
+
+		succeeded = []
+		rejected = []
+		retry = []
+		for record in batch:
+			status, text = self.post(self.url, record, 'datapoints')
+			if status == 200:
+				succeeded.append(record)
+				continue
+			logging.error('Problem creating datapoint : [%s] - %s' % (str(status), text))
+			if isTransientError(status):
+				retry.append(record)
+			else:
+				rejected.append(record)
+		return succeeded, rejected, retry
+
+	# POST the body as JSON, and return the status and text of the response.
+	# The status is None if the request failed without a response.
+	def post(self, url, body, endpoint):
+		with RequestSlot():
+			start = time.time()
+			try:
+				r = self.session.post(url, data=json.dumps(body), headers={'Content-type': 'application/json'})
+				status, text = r.status_code, r.text
+			except requests.RequestException as e:
+				status, text = None, str(e)
+			countRequest(endpoint, status, time.time() - start)
+		return status, text
+
+# ----------------------------------------------------------------------
+# Uploads datapoints from a pool of threads.
+# submit() gathers records into batches of each stream and queues them as they fill, blocking while the queue is full,
+# so a producer can't get ahead of the uploads by more than queueSize batches.
+# Batches fill across submit() calls, the ones left partly filled are queued by close().
+# close() waits for every queued batch and returns the total counts, abort() drops the ones not started.
+class UploadPool(object):
+	def __init__(self, host, key, workers = UPLOAD_WORKERS, batchSize = BULK_BATCH_SIZE, queueSize = UPLOAD_QUEUE_SIZE, retries = UPLOAD_RETRIES, backoff = UPLOAD_BACKOFF, ledger = None):
+		self.host = host
+		self.key = key
+		self.batchSize = batchSize
+		self.retries = retries
+		self.backoff = backoff
+		self.ledger = ledger
+		self.queue = Queue.Queue(max(int(queueSize), 1))
+		# stream id -> records waiting for their batch to fill, in the order streams were first seen.
+		self.pending = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.summary = newSummary()
+		# The requests of the upload count towards the message submitting it.
+		self.counts = METRICS.collector()
+		self.threads = []
+		for x in xrange(max(int(workers), 1)):
+			thread = threading.Thread(target=self.work, name='upload-%s' % x)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def submit(self, records):
+		batchSize = max(int(self.batchSize), 1)
+		for record in records:
+			batch = self.pending.setdefault(record.get('stream_id'), [])
+			batch.append(record)
+			if len(batch) >= batchSize:
+				del self.pending[record.get('stream_id')]
+				self.queue.put(batch)
+
+	def close(self):
+		for batch in self.pending.values():
+			self.queue.put(batch)
+		self.pending.clear()
+		for thread in self.threads:
+			self.queue.put(None)
+		for thread in self.threads:
+			thread.join()
+		self.threads = []
+		return self.summary
+
+	# Drop the batches still queued, wait for the ones being uploaded, and stop the threads.
+	# This is for a message that failed, so nothing more is posted for it.
+	def abort(self):
+		self.pending.clear()
+		while True:
+			try:
+				self.queue.get_nowait()
+			except Queue.Empty:
+				break
+		return self.close()
+
+	def work(self):
+		METRICS.attach(self.counts)
+		# Each worker keeps its own session, requests.Session isn't safe to share between threads.
+		uploader = DatapointUploader(self.host, self.key, self.batchSize, requests.Session(), self.retries, self.backoff, self.ledger)
+		while True:
+			batch = self.queue.get()
+			if batch == None:
+				return
+			try:
+				summary = uploader.send(batch)
+			except Exception as e:
+				logging.exception('Problem uploading datapoints : %s' % e)
+				summary = newSummary()
+				summary['batches'] = 1
+				summary['failed'] = len(batch)
+				summary['failed_records'] = list(batch)
+			with self.lock:
+				addSummary(self.summary, summary)
+
+# Make a request to Clowder with requests, counting it in METRICS under the given endpoint.
+def clowder_request(method, endpoint, url, **kwargs):
+	with RequestSlot():
+		start = time.time()
+		try:
+			r = requests.request(method, url, **kwargs)
+		except requests.RequestException:
+			countRequest(endpoint, None, time.time() - start)
+			raise
+		countRequest(endpoint, r.status_code, time.time() - start)
+	return r
+
+# Allow at most count requests to Clowder in flight at once, 0 for no limit.
+# This bounds the load of several messages handled at the same time, whatever their upload workers.
+def limit_requests(count):
+	global REQUEST_SLOTS
+	REQUEST_SLOTS = threading.BoundedSemaphore(count) if count > 0 else None
+
+# Wait for a free request slot in the block of a with statement, if requests are limited.
+class RequestSlot(object):
+	def __enter__(self):
+		self.slots = REQUEST_SLOTS
+		if self.slots != None:
+			self.slots.acquire()
+		return self
+
+	def __exit__(self, type, value, traceback):
+		if self.slots != None:
+			self.slots.release()
+		return False
+
+# Count a request made to Clowder in METRICS. A status of None means no response.
+def countRequest(endpoint, status, seconds):
+	METRICS.observe('clowder_request_seconds', seconds, endpoint=endpoint)
+	METRICS.inc('clowder_requests_total', endpoint=endpoint, status=status or 'error')
+	if status != 200:
+		METRICS.inc('clowder_request_failures_total', endpoint=endpoint)
+
+def newSummary():
+	return {
+		'batches': 0,
+		'succeeded': 0,
+		'skipped': 0,
+		'queued': 0,
+		'failed': 0,
+		'refused': 0,
+		'retries': 0,
+		'failed_records': [],
+		'refused_records': []
+	}
+
+def addSummary(total, summary):
+	for count in ('batches', 'succeeded', 'skipped', 'queued', 'failed', 'refused', 'retries'):
+		total[count] += summary[count]
+	total['failed_records'] += summary['failed_records']
+	total['refused_records'] += summary['refused_records']
+	return total
+
+# Save records as JSON back to GeoStream.
+# This returns the counts of batches, retries, and of datapoints that succeeded, were skipped and failed, the refused ones included.
+# Datapoints found in the ledger, if one is given, are skipped.
+def upload_datapoints(host, key, records, batchSize = BULK_BATCH_SIZE, ledger = None):
+	return DatapointUploader(host, key, batchSize, ledger = ledger).upload(records)